@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re
+import sys
+import mmap
+import struct
+import bisect
+import pprint
+
+from finalProject import shape_element
+from sketches import get_elements
+"""
+Address lookup index over the shaped documents.
+
+The cleaned address.street / housenumber / postcode fields produced by
+update_street_name and update_post_codes can otherwise only be searched with a
+collection scan in MongoDB. build_index writes them to a single file that
+AddressIndex memory maps:
+
+    8 bytes        magic "OSMADR1\\n"
+    8 x 8 bytes    number of streets, number of rows, and the byte offsets of
+                   the streets table, the rows table and the string blob
+    streets        one record per distinct normalized street, sorted:
+                   key offset, key length, first row, number of rows
+    rows           one record per address, grouped by street and sorted by
+                   housenumber: street, housenumber offset/length,
+                   postcode offset/length, id offset/length, lat, lon
+    strings        utf-8 text referenced by the offsets above
+
+Streets are normalized (lower case, single spaces) and compared as utf-8
+bytes, so exact and prefix lookups are a binary search over the streets table
+followed by a scan of the matching rows, with no loading step:
+
+    index = AddressIndex('san-jose_california.osm.addr')
+    index.lookup("North First Street", housenumber="1412")
+    index.prefix("north fi", postcode="95112")
+"""
+
+MAGIC = "OSMADR1\n"
+HEADER = struct.Struct("=8q")
+STREET = struct.Struct("=4q")
+ROW = struct.Struct("=7q2d")
+
+leading_number = re.compile(r'^(\d+)')
+
+
+def normalize_street(name):
+    return " ".join(name.lower().split())
+
+
+def postcode_of(address):
+    """ update_post_codes stores the postcode as a one element list """
+    pc = address.get('postcode')
+    if isinstance(pc, list):
+        pc = pc[0] if pc else None
+    return pc
+
+
+def housenumber_key(housenumber):
+    """ Sort "9" before "10", then by the full text """
+    m = leading_number.match(housenumber)
+    return (int(m.group(1)) if m else sys.maxint, housenumber)
+
+
+def _utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def build_index(docs, out):
+    """ Write the address index of the shaped documents 'docs' to 'out' """
+    entries = []
+    for doc in docs:
+        address = doc.get('address', {})
+        if 'street' not in address:
+            continue
+        pos = doc.get('pos') or (float('nan'), float('nan'))
+        entries.append((_utf8(normalize_street(address['street'])),
+                        _utf8(address.get('housenumber', "")),
+                        _utf8(postcode_of(address) or ""),
+                        _utf8(unicode(doc.get('id', ""))), pos[0], pos[1]))
+    entries.sort(key=lambda e: (e[0], housenumber_key(e[1])))
+
+    blob = bytearray()
+    strings = {}
+
+    def intern(s):
+        if s not in strings:
+            strings[s] = len(blob)
+            blob.extend(s)
+        return strings[s], len(s)
+
+    streets, rows = [], []
+    for street, hn, pc, ident, lat, lon in entries:
+        if not streets or streets[-1][0] != street:
+            streets.append([street, len(rows), 0])
+        streets[-1][2] += 1
+        rows.append(ROW.pack(len(streets) - 1, *(intern(hn) + intern(pc) + intern(ident) + (lat, lon))))
+    street_records = [STREET.pack(*(intern(street) + (first, count))) for street, first, count in streets]
+
+    streets_at = len(MAGIC) + HEADER.size
+    rows_at = streets_at + STREET.size * len(streets)
+    strings_at = rows_at + ROW.size * len(rows)
+    with open(out, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(HEADER.pack(len(streets), len(rows), streets_at, rows_at, strings_at, len(blob), 0, 0))
+        fo.write("".join(street_records))
+        fo.write("".join(rows))
+        fo.write(blob)
+    return len(streets), len(rows)
+
+
+def build_index_from_map(file_in, out=None):
+    """ Shape the map file and index its addresses in '<file>.addr' """
+    def docs():
+        for element in get_elements(file_in):
+            el = shape_element(element)
+            if el:
+                yield el
+    return build_index(docs(), out or "{0}.addr".format(file_in))
+
+
+class _StreetKeys(object):
+    """ The sorted street keys, read from the map on demand (for bisect) """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_streets
+
+    def __getitem__(self, i):
+        return self.index.street_key(i)
+
+
+class _HousenumberKeys(object):
+    """ housenumber_key of every row, read from the map on demand (for bisect) """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_rows
+
+    def __getitem__(self, row):
+        return housenumber_key(self.index.housenumber(row))
+
+
+class AddressIndex(object):
+    """ Memory mapped exact / prefix lookups of addresses by street """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.buf[:len(MAGIC)] == MAGIC, "not an address index: {0}".format(path)
+        (self.num_streets, self.num_rows, self.streets_at, self.rows_at,
+         self.strings_at, _, _, _) = HEADER.unpack_from(self.buf, len(MAGIC))
+        self.keys = _StreetKeys(self)
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _string(self, offset, length):
+        start = self.strings_at + offset
+        return self.buf[start:start + length]
+
+    def street_key(self, i):
+        offset, length, _, _ = STREET.unpack_from(self.buf, self.streets_at + STREET.size * i)
+        return self._string(offset, length)
+
+    def housenumber(self, row):
+        _, hn_off, hn_len = ROW.unpack_from(self.buf, self.rows_at + ROW.size * row)[:3]
+        return self._string(hn_off, hn_len).decode('utf-8')
+
+    def _rows(self, i, housenumber=None, postcode=None):
+        _, _, first, count = STREET.unpack_from(self.buf, self.streets_at + STREET.size * i)
+        street = self.street_key(i).decode('utf-8')
+        end = first + count
+        if housenumber is not None:
+            # rows of a street are sorted by housenumber_key
+            first = bisect.bisect_left(_HousenumberKeys(self), housenumber_key(housenumber), first, end)
+        for row in xrange(first, end):
+            (_, hn_off, hn_len, pc_off, pc_len, id_off, id_len,
+             lat, lon) = ROW.unpack_from(self.buf, self.rows_at + ROW.size * row)
+            hn = self._string(hn_off, hn_len).decode('utf-8')
+            pc = self._string(pc_off, pc_len).decode('utf-8')
+            if housenumber is not None and hn != housenumber:
+                break
+            if postcode is not None and pc != postcode:
+                continue
+            yield {"street": street, "housenumber": hn, "postcode": pc or None,
+                   "id": self._string(id_off, id_len), "pos": [lat, lon]}
+
+    def lookup(self, street, housenumber=None, postcode=None):
+        """ Addresses on exactly this street (normalized), optionally one housenumber / postcode """
+        key = _utf8(normalize_street(street))
+        i = bisect.bisect_left(self.keys, key)
+        if i == self.num_streets or self.keys[i] != key:
+            return []
+        return list(self._rows(i, housenumber, postcode))
+
+    def prefix(self, prefix, postcode=None, limit=100):
+        """ Addresses on the streets starting with 'prefix', optionally in one postcode """
+        key = _utf8(normalize_street(prefix))
+        found = []
+        i = bisect.bisect_left(self.keys, key)
+        while i < self.num_streets and len(found) < limit:
+            if not self.keys[i].startswith(key):
+                break
+            for row in self._rows(i, postcode=postcode):
+                found.append(row)
+                if len(found) == limit:
+                    break
+            i += 1
+        return found
+
+
+def test():
+    import finalProject
+    data = finalProject.process_map('example.osm')
+    print build_index_from_map('example.osm')
+    with AddressIndex('example.osm.addr') as index:
+        addressed = [d for d in data if 'street' in d.get('address', {})]
+        assert index.num_rows == len(addressed)
+        for doc in addressed:
+            found = index.lookup(doc['address']['street'], doc['address'].get('housenumber'))
+            assert doc['id'] in [row["id"] for row in found]
+        doc = [d for d in addressed if 'postcode' in d['address']][0]
+        street = doc['address']['street']
+        rows = index.prefix(street[:3].upper(), postcode=postcode_of(doc['address']))
+        pprint.pprint(rows[:3])
+        assert doc['id'] in [row["id"] for row in rows]
+        assert index.lookup("No Such Street") == []
+        assert index.prefix("zzz") == []
+
+
+if __name__ == "__main__":
+    test()
@@ -10,12 +10,16 @@ Your task in this exercise has two steps:
     We have provided a simple test so that you see what exactly is expected
 """
 import xml.etree.cElementTree as ET
-from collections import defaultdict
+from collections import defaultdict, Counter
 import re
+import math
 import pprint
 
+from osminput import open_osm
+
 OSMFILE = "example.osm"
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+vowel_re = re.compile(r'[aeiou]', re.IGNORECASE)
 
 
 expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
@@ -43,7 +47,7 @@ def is_street_name(elem):
 
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
+    osm_file = open_osm(osmfile)
     street_types = defaultdict(set)
     for event, elem in ET.iterparse(osm_file, events=("start",)):
 
@@ -55,6 +59,159 @@ def audit(osmfile):
     return street_types
 
 
+def street_type_counts(osmfile):
+    """ Number of street names per street type, for all the street types """
+    counts = Counter()
+    examples = defaultdict(set)
+    with open_osm(osmfile) as osm:
+        for event, elem in ET.iterparse(osm):
+            if elem.tag == "tag" and is_street_name(elem):
+                m = street_type_re.search(elem.attrib['v'])
+                if m:
+                    counts[m.group()] += 1
+                    if len(examples[m.group()]) < 3:
+                        examples[m.group()].add(elem.attrib['v'])
+    return counts, examples
+
+
+def normalize(street_type):
+    return street_type.lower().replace(".", "")
+
+
+def ngrams(word, n=3):
+    """ Character n-grams of the padded word """
+    padded = "^" + word + "$"
+    return set(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def is_abbreviation(short, full):
+    """ True if 'short' keeps the first letter of 'full' and the rest of its letters in order (Blvd -> Boulevard) """
+    if not short or short[0] != full[0] or len(short) >= len(full):
+        return False
+    letters = iter(full)
+    return all(c in letters for c in short)
+
+
+def looks_abbreviated(street_type):
+    """ Ends in a dot, is three letters or less or has no vowel after the first letter (St., Ave, Blvd) """
+    return (street_type.endswith(".") or len(street_type) <= 3
+            or vowel_re.search(street_type[1:]) is None)
+
+
+def similarity(variant, canonical, variant_grams, canonical_grams, abbreviated=False):
+    """ 1.0 for an abbreviation (only if 'abbreviated') or a single dropped letter (Steet),
+    otherwise the Jaccard similarity of the n-grams """
+    if is_abbreviation(variant, canonical) and (abbreviated or len(variant) == len(canonical) - 1):
+        return 1.0
+    return float(len(variant_grams & canonical_grams)) / len(variant_grams | canonical_grams)
+
+
+class NgramIndex(object):
+    """ Inverted index from n-gram to the canonical street types that contain it.
+
+    A type with a Jaccard similarity of at least 'threshold' to a key shares at
+    least threshold * len(key n-grams) n-grams with it, so it is found in the
+    postings of the len(key n-grams) - overlap + 1 rarest n-grams of the key
+    (prefix filtering) and the candidates are kept only if they share enough
+    n-grams (count filtering). Abbreviations share no n-grams with their full
+    form, they are looked up by their first letter and the letters they keep.
+    """
+
+    def __init__(self):
+        self.index = defaultdict(set)
+        self.letters = defaultdict(set)
+        self.grams = {}
+
+    def add(self, key):
+        self.grams[key] = ngrams(key)
+        for gram in self.grams[key]:
+            self.index[gram].add(key)
+        for letter in set(key[1:]) | set([""]):
+            self.letters[key[:1], letter].add(key)
+
+    def candidates(self, key, key_grams, threshold, abbreviated=False):
+        """ The indexed types that can score at least 'threshold' against key """
+        overlap = max(int(math.ceil(threshold * len(key_grams) - 1e-9)), 1)
+        rarest = sorted(key_grams, key=lambda gram: len(self.index.get(gram, ())))
+        found = set()
+        for gram in rarest[:len(key_grams) - overlap + 1]:
+            found |= self.index.get(gram, set())
+        found = set(c for c in found if len(key_grams & self.grams[c]) >= overlap)
+        if abbreviated and key:
+            # types that start with the same letter and contain all the others
+            postings = sorted((self.letters.get((key[0], letter), set())
+                               for letter in set(key[1:]) | set([""])), key=len)
+            found |= postings[0].intersection(*postings[1:])
+        return found
+
+    def best_match(self, key, weights, threshold, abbreviated=False):
+        """ (score, canonical key) of the closest indexed type, or None """
+        key_grams = ngrams(key)
+        scored = [(similarity(key, c, key_grams, self.grams[c], abbreviated), weights.get(c, 0), c)
+                  for c in self.candidates(key, key_grams, threshold, abbreviated)]
+        scored = [s for s in scored if s[0] >= threshold]
+        if not scored:
+            return None
+        score, _, best = max(scored)
+        return score, best
+
+
+def cluster_street_types(counts, expected=expected, min_count=5, threshold=0.5):
+    """ Group the street type variants around a canonical type and propose 'mapping' entries.
+
+    Variants that only differ in case or dots are grouped directly. The canonical
+    types are the expected ones plus the frequent full words (Park, Loop, ...)
+    that are not a near duplicate of an expected type; they go in an n-gram
+    inverted index, so each variant is only compared with the canonical types it
+    shares an n-gram with instead of with every other street type. The
+    abbreviation rule (Blvd -> Boulevard) only applies to variants that look
+    abbreviated, which frequent full words never do.
+    """
+    groups = defaultdict(Counter)
+    for street_type, count in counts.items():
+        groups[normalize(street_type)][street_type] += count
+    weights = dict((key, sum(variants.values())) for key, variants in groups.items())
+
+    canonical = {}
+    index = NgramIndex()
+    for street_type in expected:
+        canonical[normalize(street_type)] = street_type
+        index.add(normalize(street_type))
+    for key in sorted(groups, key=lambda key: -weights[key]):
+        best, count = groups[key].most_common(1)[0]
+        if (key not in canonical and count >= min_count and not looks_abbreviated(best)
+                and index.best_match(key, weights, threshold) is None):
+            canonical[key] = best
+            index.add(key)
+
+    proposals = []
+    for key, variants in groups.items():
+        target = canonical.get(key)
+        score = 1.0
+        if target is None:
+            abbreviated = any(looks_abbreviated(v) for v in variants)
+            match = index.best_match(key, weights, threshold, abbreviated)
+            if match is None:
+                continue
+            score, best = match
+            target = canonical[best]
+        for street_type, count in variants.items():
+            if street_type != target:
+                proposals.append({"variant": street_type, "canonical": target,
+                                  "count": count, "score": score})
+    proposals.sort(key=lambda p: -p["count"])
+    return proposals
+
+
+def suggest_mapping(osmfile, expected=expected, min_count=5, threshold=0.5):
+    """ Proposed additions to 'mapping' for the street types found in osmfile """
+    counts, examples = street_type_counts(osmfile)
+    proposals = cluster_street_types(counts, expected, min_count, threshold)
+    for p in proposals:
+        p["examples"] = sorted(examples[p["variant"]])
+    return proposals
+
+
 def update_name(name, mapping):
 
     # YOUR CODE HERE
@@ -67,6 +224,7 @@ def update_name(name, mapping):
 
 
 def test():
+    import random
     st_types = audit(OSMFILE)
     assert len(st_types) == 3
     pprint.pprint(dict(st_types))
@@ -80,6 +238,43 @@ def test():
             if name == "Baldwin Rd.":
                 assert better_name == "Baldwin Road"
 
+    proposals = cluster_street_types(Counter({"Boulevard": 5, "Blvd": 3, "Blvd.": 2, "Steet": 1}))
+    pprint.pprint(proposals)
+    assert set((p["variant"], p["canonical"]) for p in proposals) == \
+        set([("Blvd", "Boulevard"), ("Blvd.", "Boulevard"), ("Steet", "Street")])
+    assert cluster_street_types(Counter({"Park": 50})) == []
+    assert cluster_street_types(Counter({"Park": 2})) == []
+    assert [(p["variant"], p["canonical"]) for p in cluster_street_types(Counter({"Pkwy": 50}))] == \
+        [("Pkwy", "Parkway")]
+
+    # street types with a typo and an abbreviation each: the comparisons per type stay bounded
+    def random_types(n, seed=7):
+        rng = random.Random(seed)
+        types = Counter()
+        while len(types) < n:
+            word = "".join(rng.choice("abcdefghiklmnoprstuvwy") for _ in range(rng.randint(6, 10)))
+            word = word.capitalize()
+            i = rng.randrange(1, len(word))
+            types[word] += 20
+            types[word[:i] + word[i + 1:]] += 1
+            types[word[0] + "".join(c for c in word[1:] if c not in "aeiou")[:3] + "."] += 2
+        return types
+
+    global similarity
+    score, calls = similarity, []
+
+    def counted(*args):
+        calls.append(1)
+        return score(*args)
+    similarity = counted
+    try:
+        for n in (2000, 8000):
+            del calls[:]
+            cluster_street_types(random_types(n))
+            assert len(calls) < 2 * n, (n, len(calls))
+    finally:
+        similarity = score
+
 
 if __name__ == '__main__':
     test()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import resource
+import traceback
+import subprocess
+import multiprocessing
+import pprint
+
+import finalProject
+from conversion import convert_documents
+from reportcache import MONGO_URI, bump_generation_at
+from sketches import get_elements
+"""
+Batch runner for many metro extracts.
+
+finalProject.test() hard codes one region (san-jose_california.osm, the
+'sanjose' collection of the 'examples' database). run_batch takes a list of
+regions instead, each with its own cleaning tables:
+
+    [{"name": "sanjose",
+      "osm": "san-jose_california.osm",
+      "db": "examples",                    # optional, default "examples"
+      "collection": "sanjose",             # optional, default the name
+      "expected": ["Street", ...],         # optional, default finalProject.expected
+      "mapping": {"St": "Street", ...},    # optional, default finalProject.mapping
+      "postcode_patterns": ["^(\\\\d{5})(-\\\\d{4})?$", "^CA ?(\\\\d{5})$"]},   # optional
+     ...]
+
+Every region is parsed and shaped with finalProject.shape_element, written
+to '<osm>.json' as it goes (the same json array finalProject.process_map
+writes, without keeping the documents in memory) and loaded with mongoimport
+into its own collection, in a separate worker process:
+
+- at most 'workers' regions run at the same time
+- 'memory_mb' caps the address space of each worker (a region that needs more
+  fails with a MemoryError instead of taking the machine down)
+- 'cpu_seconds' caps the cpu time of each worker
+- 'nice' lowers the priority of the workers
+
+Each worker sets the cleaning tables of its region on finalProject before it
+starts, which is safe since no two regions share a process. A worker that dies
+(e.g. killed for going over its cpu limit) is reported as a failure.
+
+The summary has, per region, the status, the documents written, the input size
+and the parse/shape and load times with their throughput, and the totals for
+the whole batch:
+
+    python batch.py regions.json --workers 4 --memory-mb 2048 --out summary.json
+"""
+
+MONGOIMPORT = "/usr/local/bin/mongoimport"
+
+
+def postcode_cleaner(patterns):
+    """ An update_post_codes that keeps the first group of the first matching pattern
+
+    Like finalProject.update_post_codes, the postcode is stored as a one element list """
+    compiled = [re.compile(p) for p in patterns]
+
+    def update_post_codes(tag, node):
+        postcode = tag.attrib['v']
+        for pattern in compiled:
+            m = pattern.match(postcode)
+            if m:
+                node['address']['postcode'] = [m.group(1)]
+                return True
+        return False
+    return update_post_codes
+
+
+def configure(region):
+    """ Install the cleaning tables of 'region' on finalProject """
+    if 'expected' in region:
+        finalProject.expected = region['expected']
+    if 'mapping' in region:
+        finalProject.mapping = region['mapping']
+    if 'postcode_patterns' in region:
+        finalProject.update_post_codes = postcode_cleaner(region['postcode_patterns'])
+
+
+def write_region(file_in, file_out, typed=False):
+    """ Shape the map file into a json array in 'file_out', one document at a time
+    (typed documents are converted in batches). Returns the number of documents written """
+    def shaped():
+        for element in get_elements(file_in):
+            el = finalProject.shape_element(element)
+            if el:
+                yield el
+
+    docs = shaped()
+    if typed:
+        docs = convert_documents(docs)
+    count = 0
+    with open(file_out, "w") as fo:
+        fo.write("[")
+        for el in docs:
+            if count:
+                fo.write(",\n")
+            fo.write(json.dumps(el))
+            count += 1
+        fo.write("]")
+    return count
+
+
+def load_region(json_file, db, collection, mongoimport=MONGOIMPORT, mongo_uri=MONGO_URI):
+    """ mongoimport the shaped documents of one region, return the exit code.
+    A successful import makes the cached report of the collection stale """
+    code = subprocess.call([mongoimport, "--db", db, "--collection", collection,
+                            "--file", json_file, "--jsonArray"])
+    if code == 0:
+        bump_generation_at(db, collection, mongo_uri)
+    return code
+
+
+def run_region(region, options):
+    """ Shape and load one region, return its summary """
+    summary = {"name": region['name'], "osm": region['osm'], "status": "ok"}
+    summary["input_bytes"] = os.path.getsize(region['osm'])
+    configure(region)
+
+    start = time.time()
+    json_file = "{0}.json".format(region['osm'])
+    summary["docs"] = write_region(region['osm'], json_file, options.get('typed', False))
+    summary["shape_seconds"] = time.time() - start
+    summary["shape_mb_per_second"] = summary["input_bytes"] / 1e6 / max(summary["shape_seconds"], 1e-9)
+    summary["docs_per_second"] = summary["docs"] / max(summary["shape_seconds"], 1e-9)
+
+    if options.get('load', True):
+        start = time.time()
+        code = load_region(json_file, region.get('db', "examples"),
+                           region.get('collection', region['name']),
+                           options.get('mongoimport', MONGOIMPORT),
+                           options.get('mongo_uri', MONGO_URI))
+        summary["load_seconds"] = time.time() - start
+        if code != 0:
+            summary["status"] = "failed"
+            summary["error"] = "mongoimport exited with {0}".format(code)
+    summary["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return summary
+
+
+def _worker(region, options, results):
+    """ Entry point of the worker processes: apply the limits, run the region, report back """
+    try:
+        if options.get('memory_mb'):
+            limit = options['memory_mb'] * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        if options.get('cpu_seconds'):
+            resource.setrlimit(resource.RLIMIT_CPU, (options['cpu_seconds'], options['cpu_seconds']))
+        if options.get('nice'):
+            os.nice(options['nice'])
+        results.put(run_region(region, options))
+    except BaseException as e:
+        results.put({"name": region['name'], "osm": region['osm'], "status": "failed",
+                     "error": "{0}: {1}".format(type(e).__name__, e),
+                     "traceback": traceback.format_exc()})
+
+
+def run_batch(regions, workers=2, **options):
+    """ Run every region with at most 'workers' at a time, return the combined summary """
+    start = time.time()
+    results = multiprocessing.Queue()
+    pending = list(regions)
+    running = {}
+    done = {}
+
+    while pending or running:
+        while pending and len(running) < workers:
+            region = pending.pop(0)
+            proc = multiprocessing.Process(target=_worker, args=(region, options, results))
+            proc.start()
+            running[region['name']] = (region, proc)
+        try:
+            summary = results.get(timeout=0.1)
+            done[summary['name']] = summary
+        except Queue.Empty:
+            pass
+        for name, (region, proc) in running.items():
+            if name in done:
+                proc.join()
+                del running[name]
+            elif not proc.is_alive() and results.empty():
+                done[name] = {"name": name, "osm": region['osm'], "status": "failed",
+                              "error": "worker exited with {0}".format(proc.exitcode)}
+                del running[name]
+
+    elapsed = time.time() - start
+    per_region = [done[region['name']] for region in regions]
+    ok = [s for s in per_region if s['status'] == "ok"]
+    total_bytes = sum(s.get('input_bytes', 0) for s in ok)
+    total_docs = sum(s.get('docs', 0) for s in ok)
+    return {"regions": per_region,
+            "elapsed_seconds": elapsed,
+            "succeeded": len(ok),
+            "failed": [s['name'] for s in per_region if s['status'] != "ok"],
+            "input_bytes": total_bytes,
+            "docs": total_docs,
+            "mb_per_second": total_bytes / 1e6 / max(elapsed, 1e-9),
+            "docs_per_second": total_docs / max(elapsed, 1e-9)}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Wrangle many OSM extracts concurrently")
+    parser.add_argument("regions", help="json file with the list of regions")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--memory-mb", type=int, help="address space limit per worker")
+    parser.add_argument("--cpu-seconds", type=int, help="cpu time limit per worker")
+    parser.add_argument("--nice", type=int, default=0)
+    parser.add_argument("--no-load", action="store_true", help="only shape, skip mongoimport")
+    parser.add_argument("--typed", action="store_true", help="convert ids and timestamps")
+    parser.add_argument("--out", help="write the json summary here instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.regions) as f:
+        regions = json.load(f)
+    summary = run_batch(regions, args.workers, memory_mb=args.memory_mb,
+                        cpu_seconds=args.cpu_seconds, nice=args.nice,
+                        load=not args.no_load, typed=args.typed)
+    if args.out:
+        with open(args.out, "w") as fo:
+            json.dump(summary, fo, indent=2)
+    else:
+        print json.dumps(summary, indent=2)
+    sys.exit(1 if summary["failed"] else 0)
+
+
+def test():
+    import xml.etree.cElementTree as ET
+    data = finalProject.process_map('example.osm')
+    assert write_region('example.osm', 'example.osm.stream.json') == len(data)
+    with open('example.osm.stream.json') as f:
+        assert json.load(f) == json.loads(json.dumps(data))
+    typed = finalProject.process_map('example.osm', typed=True)
+    assert write_region('example.osm', 'example.osm.stream.json', typed=True) == len(typed)
+    with open('example.osm.stream.json') as f:
+        assert json.load(f) == json.loads(json.dumps(typed))
+
+    update_post_codes = postcode_cleaner([r'^(\d{5})(-\d{4})?$'])
+    node = {"address": {}}
+    assert update_post_codes(ET.Element("tag", {"k": "addr:postcode", "v": "95112-1234"}), node)
+    assert node["address"]["postcode"] == ["95112"]
+
+    regions = [{"name": "example", "osm": "example.osm",
+                "mapping": {"St": "Street", "St.": "Street", "Blvd": "Boulevard"},
+                "postcode_patterns": [r'^(\d{5})(-\d{4})?$', r'^CA ?(\d{5})$']},
+               {"name": "missing", "osm": "no-such-file.osm"}]
+    summary = run_batch(regions, workers=2, load=False)
+    pprint.pprint(summary)
+    assert summary["succeeded"] == 1
+    assert summary["failed"] == ["missing"]
+    assert summary["regions"][0]["docs"] > 0
+
+
+if __name__ == "__main__":
+    main()
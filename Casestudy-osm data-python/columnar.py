@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import json
+import pprint
+from array import array
+
+import numpy as np
+
+from finalProject import shape_element
+from conversion import to_epoch
+from sketches import get_elements
+"""
+Columnar analytics over the shaped documents, without MongoDB.
+
+The questions asked in finalProject.query_and_update_data need a running
+MongoDB and a full import. ColumnStore keeps the fields those questions use as
+NumPy columns instead:
+
+- the string fields (type, amenity, cuisine, religion, name, postcode, user)
+  are dictionary encoded: every distinct value gets an int32 code, code 0 means
+  the field is missing
+- timestamp is stored as int64 seconds since the epoch (-1 when missing)
+- lat / lon are float64 (nan for ways)
+
+Filters are boolean masks built with vectorized comparisons on the codes and
+group-by / count / top-k are np.bincount plus a sort, so each question is a
+pass over a few int32 arrays. group_count returns the same
+[{"_id": value, "count": n}, ...] lists the MongoDB aggregations return.
+
+The columns can be saved as .npy files and loaded back memory mapped, so a
+saved store opens instantly whatever its size:
+
+    store = ColumnStore.from_map('san-jose_california.osm')
+    store.save('san-jose_california.osm.columns')
+    store = ColumnStore.load('san-jose_california.osm.columns')
+    pprint.pprint(report(store))
+"""
+
+STRING_COLUMNS = ["type", "amenity", "cuisine", "religion", "name", "postcode", "user"]
+EXISTS = object()   # filter value: the field is present
+
+
+def _key(value):
+    """ Hashable version of a value (update_post_codes stores postcodes as lists) """
+    return tuple(value) if isinstance(value, list) else value
+
+
+def field(doc, column):
+    """ Value of 'column' in a shaped document, or None """
+    if column == "postcode":
+        return doc.get('address', {}).get('postcode')
+    if column in ("user", "timestamp"):
+        return doc.get('created', {}).get(column)
+    return doc.get(column)
+
+
+class Dictionary(object):
+    """ value <-> int code, code 0 is reserved for missing values """
+
+    def __init__(self, values=None):
+        self.values = [None] + list(values or [])
+        self.codes = dict((_key(v), i) for i, v in enumerate(self.values) if i)
+
+    def encode(self, value):
+        if value is None:
+            return 0
+        key = _key(value)
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def code(self, value):
+        """ Code of an existing value, -1 if the value never occurs """
+        return self.codes.get(_key(value), -1)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class ColumnStore(object):
+    """ Dictionary encoded NumPy columns of the shaped documents """
+
+    def __init__(self, columns, dictionaries):
+        self.columns = columns
+        self.dictionaries = dictionaries
+
+    def __len__(self):
+        return len(self.columns["type"])
+
+    @classmethod
+    def from_documents(cls, docs):
+        """ Build the columns from an iterable of shaped documents """
+        dictionaries = dict((c, Dictionary()) for c in STRING_COLUMNS)
+        codes = dict((c, array('i')) for c in STRING_COLUMNS)
+        timestamps = array('d')
+        lats, lons = array('d'), array('d')
+        for doc in docs:
+            for c in STRING_COLUMNS:
+                codes[c].append(dictionaries[c].encode(field(doc, c)))
+            ts = field(doc, "timestamp")
+            timestamps.append(to_epoch(ts) if ts else -1)
+            pos = doc.get('pos') or (float('nan'), float('nan'))
+            lats.append(pos[0])
+            lons.append(pos[1])
+
+        columns = dict((c, np.frombuffer(codes[c], dtype=np.int32).copy()) for c in STRING_COLUMNS)
+        columns["timestamp"] = np.frombuffer(timestamps, dtype=np.float64).astype(np.int64)
+        columns["lat"] = np.frombuffer(lats, dtype=np.float64).copy()
+        columns["lon"] = np.frombuffer(lons, dtype=np.float64).copy()
+        return cls(columns, dictionaries)
+
+    @classmethod
+    def from_map(cls, file_in):
+        """ Build the columns straight from the map file, without keeping the documents """
+        def docs():
+            for element in get_elements(file_in):
+                el = shape_element(element)
+                if el:
+                    yield el
+        return cls.from_documents(docs())
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, column in self.columns.items():
+            np.save(os.path.join(directory, "{0}.npy".format(name)), column)
+        with open(os.path.join(directory, "dictionaries.json"), "w") as fo:
+            json.dump(dict((c, d.values[1:]) for c, d in self.dictionaries.items()), fo)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, "dictionaries.json")) as f:
+            dictionaries = dict((c, Dictionary(v)) for c, v in json.load(f).items())
+        columns = {}
+        for name in STRING_COLUMNS + ["timestamp", "lat", "lon"]:
+            columns[name] = np.load(os.path.join(directory, "{0}.npy".format(name)),
+                                    mmap_mode=mmap_mode)
+        return cls(columns, dictionaries)
+
+    def mask(self, **filters):
+        """ Boolean mask of the documents where every column equals its value (or EXISTS) """
+        result = np.ones(len(self), dtype=bool)
+        for column, value in filters.items():
+            codes = self.columns[column]
+            if value is EXISTS:
+                result &= codes != 0
+            elif value is None:
+                result &= codes == 0
+            else:
+                result &= codes == self.dictionaries[column].code(value)
+        return result
+
+    def count(self, **filters):
+        return int(np.count_nonzero(self.mask(**filters)))
+
+    def group_count(self, column, where=None, include_missing=False, limit=None):
+        """ [{"_id": value, "count": n}] for the documents in 'where', largest counts first """
+        codes = self.columns[column]
+        if where is not None:
+            codes = codes[where]
+        counts = np.bincount(codes, minlength=len(self.dictionaries[column]))
+        if not include_missing:
+            counts[0] = 0
+        order = np.argsort(-counts, kind='mergesort')
+        order = order[counts[order] > 0]
+        if limit is not None:
+            order = order[:limit]
+        values = self.dictionaries[column].values
+        return [{"_id": values[i], "count": int(counts[i])} for i in order]
+
+    def contributions_per_user(self):
+        """ [{"_id": number of docs, "num_users": users with that many docs}], smallest first """
+        per_user = np.bincount(self.columns["user"])
+        per_user = per_user[per_user > 0]
+        hist = np.bincount(per_user)
+        return [{"_id": int(c), "num_users": int(hist[c])} for c in np.nonzero(hist)[0]]
+
+    def set_value(self, column, where, value, first_only=True):
+        """ Change 'column' to 'value' for the matching documents (the first one, like find_one) """
+        rows = np.nonzero(where)[0]
+        if first_only:
+            rows = rows[:1]
+        if self.columns[column].flags.writeable is False:
+            self.columns[column] = np.array(self.columns[column])
+        self.columns[column][rows] = self.dictionaries[column].encode(value)
+        return len(rows)
+
+
+def report(store):
+    """ The results of finalProject.query_and_update_data, computed on the columns """
+    restaurants = store.mask(amenity="restaurant")
+    return {
+        "num_docs": len(store),
+        "num_nodes": store.count(type="node"),
+        "num_ways": store.count(type="way"),
+        "num_hospitals": store.count(amenity="hospital"),
+        "num_schools": store.count(amenity="school"),
+        "num_univ": store.count(amenity="university"),
+        "top_user": store.group_count("user", include_missing=True, limit=1),
+        "user_1time": store.contributions_per_user()[:1],
+        "pc_sorted": store.group_count("postcode"),
+        "top10_amenities": store.group_count("amenity", limit=10),
+        "all_univ": store.group_count("name", store.mask(amenity="university")),
+        "biggest_religion": store.group_count("religion", store.mask(amenity="place_of_worship"),
+                                              include_missing=True, limit=1),
+        "popular_cuisines": store.group_count("cuisine", restaurants),
+        "indian_cuisines": store.group_count("name", restaurants & store.mask(cuisine="indian")),
+        "num_indian": int(np.count_nonzero(restaurants & store.mask(cuisine="indian"))),
+    }
+
+
+def test():
+    from collections import Counter
+    import finalProject
+    data = finalProject.process_map('example.osm')
+    store = ColumnStore.from_map('example.osm')
+    result = report(store)
+    pprint.pprint(result)
+
+    assert result["num_docs"] == len(data)
+    assert result["num_nodes"] == len([d for d in data if d['type'] == "node"])
+    amenities = Counter(d['amenity'] for d in data if 'amenity' in d)
+    assert [g["count"] for g in result["top10_amenities"]] == \
+        sorted(amenities.values(), reverse=True)[:10]
+    users = Counter(d['created']['user'] for d in data)
+    assert result["top_user"][0]["count"] == max(users.values())
+    postcodes = Counter(_key(d['address']['postcode']) for d in data
+                        if 'postcode' in d.get('address', {}))
+    assert dict((_key(g["_id"]), g["count"]) for g in result["pc_sorted"]) == dict(postcodes)
+
+    store.save('example.osm.columns')
+    loaded = ColumnStore.load('example.osm.columns')
+    assert report(loaded) == result
+    loaded.set_value("cuisine", loaded.mask(amenity="restaurant", cuisine="indian"), "American")
+    assert report(loaded)["num_indian"] == result["num_indian"] - 1
+
+
+if __name__ == "__main__":
+    test()
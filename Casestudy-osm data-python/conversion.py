@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import pprint
+from collections import Counter
+"""
+Typed conversion of the shaped documents.
+
+shape_element keeps every attribute as a string, so "created.timestamp",
+"created.version", "created.changeset", "created.uid", "id" and the "node_refs"
+of ways are compared as strings in MongoDB and time range queries can't use an
+index range scan. convert_documents turns them into:
+
+- integers for the id like fields
+- seconds since the epoch (or datetime objects, which pymongo stores as BSON
+  dates) for the timestamp
+
+convert_documents works batch_size documents at a time: within a batch the
+"YYYY-MM-DD" and "HH:MM:SS" parts of the timestamps are converted once per
+distinct value (most edits of an extract share a few days), which is much
+cheaper than time.strptime on every value. The caches only live for one batch.
+process_map in finalProject and batch.write_region go through convert_documents
+when run with typed=True.
+
+create_indexes and edits_report then give the number of edits per month (one
+indexed range count per month), per user and per changeset (the documents are
+sorted on the indexed key and projected to it before the $group, so the input
+of the group is read from the index instead of the documents).
+"""
+
+INT_FIELDS = ["id"]
+CREATED_INT_FIELDS = ["version", "changeset", "uid"]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_day(day):
+    """ "2013-08-03" -> seconds since the epoch of its midnight """
+    return calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+
+
+def parse_time(t):
+    """ "16:43:42" -> seconds since midnight """
+    return int(t[0:2]) * 3600 + int(t[3:5]) * 60 + int(t[6:8])
+
+
+def parse_timestamp(ts, days=None, times=None):
+    """ "2013-08-03T16:43:42Z" -> seconds since the epoch
+
+    'days' and 'times' are optional dicts caching the parsed day and time parts """
+    if days is None or times is None:
+        return parse_day(ts[:10]) + parse_time(ts[11:19])
+    day = days.get(ts[:10])
+    if day is None:
+        day = days[ts[:10]] = parse_day(ts[:10])
+    t = times.get(ts[11:19])
+    if t is None:
+        t = times[ts[11:19]] = parse_time(ts[11:19])
+    return day + t
+
+
+def to_epoch(value):
+    """ Seconds since the epoch for a string, datetime or already converted timestamp """
+    if isinstance(value, basestring):
+        return parse_timestamp(value)
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def convert_document(doc, timestamps="epoch", days=None, times=None):
+    """ Convert the id like fields and the timestamp of one shaped document, in place """
+    for key in INT_FIELDS:
+        if key in doc:
+            doc[key] = int(doc[key])
+    created = doc.get('created', {})
+    for key in CREATED_INT_FIELDS:
+        if key in created:
+            created[key] = int(created[key])
+    if 'timestamp' in created:
+        ts = parse_timestamp(created['timestamp'], days, times)
+        if timestamps == "datetime":
+            ts = EPOCH + datetime.timedelta(seconds=ts)
+        created['timestamp'] = ts
+    if 'node_refs' in doc:
+        doc['node_refs'] = [int(ref) for ref in doc['node_refs']]
+    return doc
+
+
+def convert_batch(batch, timestamps="epoch"):
+    """ Convert a list of shaped documents, parsing each distinct day and time once """
+    days, times = {}, {}
+    for doc in batch:
+        convert_document(doc, timestamps, days, times)
+    return batch
+
+
+def convert_documents(docs, timestamps="epoch", batch_size=10000):
+    """ Yield the converted documents, converting batch_size of them at a time """
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            for d in convert_batch(batch, timestamps):
+                yield d
+            batch = []
+    for d in convert_batch(batch, timestamps):
+        yield d
+
+
+def month_starts(first, last):
+    """ The first day of every month from 'first' to 'last', plus the one after 'last'
+
+    The bounds are datetimes when the timestamps are datetimes (stored as BSON
+    dates), seconds since the epoch otherwise, so they compare with the stored values """
+    dates = isinstance(first, datetime.datetime)
+    start = first if dates else datetime.datetime.utcfromtimestamp(first)
+    year, month = start.year, start.month
+    bounds = []
+    while True:
+        t = datetime.datetime(year, month, 1)
+        if not dates:
+            t = calendar.timegm(t.utctimetuple())
+        bounds.append(t)
+        if t > last:
+            return bounds
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def month_label(bound):
+    """ "YYYY-MM" of a month bound """
+    if not isinstance(bound, datetime.datetime):
+        bound = datetime.datetime.utcfromtimestamp(bound)
+    return bound.strftime("%Y-%m")
+
+
+def create_indexes(db):
+    """ Indexes used by edits_report """
+    db.sanjose.create_index("created.timestamp")
+    db.sanjose.create_index("created.user")
+    db.sanjose.create_index("created.changeset")
+
+
+def count_by(db, key, limit=10):
+    """ [{"_id": value, "count": n}] of the indexed 'key', largest counts first """
+    return [doc for doc in db.sanjose.aggregate([{"$sort": {key: 1}},
+                                                 {"$project": {"_id": 0, key: 1}},
+                                                 {"$group": {"_id": "$" + key, "count": {"$sum": 1}}},
+                                                 {"$sort": {"count": -1}},
+                                                 {"$limit": limit}])]
+
+
+def edits_report(db, limit=10):
+    """ Edits per month, per user and per changeset on a typed collection
+
+    The timestamps can be epoch seconds or datetimes (convert_document with
+    timestamps="datetime") """
+    first = db.sanjose.find_one(sort=[("created.timestamp", 1)])
+    last = db.sanjose.find_one(sort=[("created.timestamp", -1)])
+    per_month = []
+    if first is not None:
+        bounds = month_starts(first['created']['timestamp'], last['created']['timestamp'])
+        for lo, hi in zip(bounds, bounds[1:]):
+            count = db.sanjose.find({"created.timestamp": {"$gte": lo, "$lt": hi}}).count()
+            if count:
+                per_month.append({"_id": month_label(lo), "count": count})
+
+    return {"per_month": per_month,
+            "per_user": count_by(db, "created.user", limit),
+            "per_changeset": count_by(db, "created.changeset", limit)}
+
+
+def edits_report_docs(docs, limit=10):
+    """ Same report as edits_report, computed from typed documents in memory """
+    months, users, changesets = Counter(), Counter(), Counter()
+    for doc in docs:
+        created = doc['created']
+        ts = to_epoch(created['timestamp'])
+        months[month_label(ts)] += 1
+        users[created['user']] += 1
+        changesets[created['changeset']] += 1
+
+    def ranked(counter):
+        return [{"_id": k, "count": c} for k, c in counter.most_common(limit)]
+    return {"per_month": [{"_id": m, "count": months[m]} for m in sorted(months)],
+            "per_user": ranked(users),
+            "per_changeset": ranked(changesets)}
+
+
+def test():
+    import time
+    import finalProject
+    assert parse_timestamp("2013-08-03T16:43:42Z") == \
+        calendar.timegm(time.strptime("2013-08-03T16:43:42Z", "%Y-%m-%dT%H:%M:%SZ"))
+
+    data = finalProject.process_map('example.osm')
+    typed = list(convert_documents(data))
+    assert all(isinstance(d['id'], int) and isinstance(d['created']['timestamp'], int) for d in typed)
+    way = [d for d in typed if d['type'] == "way"][0]
+    assert all(isinstance(ref, int) for ref in way['node_refs'])
+
+    report = edits_report_docs(typed)
+    pprint.pprint(report)
+    assert sum(m["count"] for m in report["per_month"]) == len(typed)
+
+    assert month_starts(datetime.datetime(2012, 11, 5), datetime.datetime(2013, 1, 1)) == \
+        [datetime.datetime(2012, 11, 1), datetime.datetime(2012, 12, 1),
+         datetime.datetime(2013, 1, 1), datetime.datetime(2013, 2, 1)]
+    assert month_starts(calendar.timegm((2012, 11, 5, 0, 0, 0)), calendar.timegm((2012, 11, 30, 0, 0, 0))) == \
+        [calendar.timegm((2012, 11, 1, 0, 0, 0)), calendar.timegm((2012, 12, 1, 0, 0, 0))]
+
+    batch = convert_batch([{"created": {"timestamp": "2012-03-28T18:31:23Z"}},
+                           {"created": {"timestamp": "2012-03-28T18:31:23Z"}}])
+    assert batch[0] == batch[1] == {"created": {"timestamp": parse_timestamp("2012-03-28T18:31:23Z")}}
+
+    dt = convert_document({"created": {"timestamp": "2012-03-28T18:31:23Z"}}, "datetime")
+    assert dt['created']['timestamp'] == datetime.datetime(2012, 3, 28, 18, 31, 23)
+
+
+if __name__ == "__main__":
+    test()
@@ -6,6 +6,10 @@ import re
 import codecs
 import json
 import os
+
+from conversion import convert_documents
+from osminput import open_osm
+from reportcache import bump_generation, cached_report, update_document
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -259,15 +263,27 @@ def shape_element(element):
         return None
 
 
-def process_map(file_in, pretty = False):
-    """ Process the xml file and write it into an output file in json format """
+def shape_map(osm):
+    """ Yield the shaped documents of the map file """
+    for _, element in ET.iterparse(osm):
+        el = shape_element(element)
+        if el:
+            yield el
+
+
+def process_map(file_in, pretty = False, typed = False):
+    """ Process the xml file and write it into an output file in json format.
+    With typed=True the id like fields and the timestamp are converted to integers,
+    in batches (see conversion.convert_documents) """
     file_out = "{0}.json".format(file_in)
     data = []
     first = None
     with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
+        with open_osm(file_in) as osm:
+            docs = shape_map(osm)
+            if typed:
+                docs = convert_documents(docs)
+            for el in docs:
                 data.append(el)
                 if first == None: 
                     fo.write("[")
@@ -287,6 +303,7 @@ def insert_data_bulk(db):
     print "num_docs before insert", num_docs
 
     os.system("/usr/local/bin/mongoimport --db examples --collection sanjose --file san-jose_california.osm.json --jsonArray")
+    bump_generation(db)
     
     num_docs = db.sanjose.find().count()
     print "num_docs after insert", num_docs
@@ -299,6 +316,7 @@ def insert_data(data, db):
 
     for a in data:
         db.sanjose.insert(a)
+    bump_generation(db)
 
     num_docs = db.sanjose.find().count()
     print "num_docs after insert", num_docs
@@ -312,100 +330,55 @@ def remove_data(client, db):
     client.drop_database("examples")
 
 def query_and_update_data(db):
-    """ query from the data base and update the data base """
-    num_docs = db.sanjose.find().count()
-    print "Number of docs", num_docs
-
-    num_nodes = db.sanjose.find({"type":"node"}).count()
-    print "Number of nodes", num_nodes
-
-    num_ways = db.sanjose.find({"type":"way"}).count()
-    print "Number of ways", num_ways
-
-    num_hospitals = db.sanjose.find({"amenity":"hospital"}).count()
-    print "Number of hospitals", num_hospitals
+    """ query from the data base and update the data base.
+    The results come from the report cache, recomputed only after a new load """
+    report = cached_report(db)
+    print "Number of docs", report["num_docs"]
+    print "Number of nodes", report["num_nodes"]
+    print "Number of ways", report["num_ways"]
+    print "Number of hospitals", report["num_hospitals"]
+    print "Number of schools", report["num_schools"]
+    print "Number of univ", report["num_univ"]
 
-    num_schools = db.sanjose.find({"amenity":"school"}).count()
-    print "Number of schools", num_schools
-    
-    num_univ = db.sanjose.find({"amenity":"university"}).count()
-    print "Number of univ", num_univ
-
-    top_user = [doc for doc in db.sanjose.aggregate([{"$group":{"_id":"$created.user", "count":{"$sum":1}}}, 
-                                  {"$sort":{"count":-1}}, 
-                                  {"$limit":1}])]
     print
     print "top_user..."
-    pprint.pprint(top_user)
+    pprint.pprint(report["top_user"])
 
-    user_1time = [doc for doc in db.sanjose.aggregate([{"$group":{"_id":"$created.user", "count":{"$sum":1}}}, 
-                                    {"$group":{"_id":"$count", "num_users":{"$sum":1}}}, 
-                                    {"$sort":{"_id":1}}, {"$limit":1}])]
     print
     print "1 time user..."
-    pprint.pprint(user_1time)
+    pprint.pprint(report["user_1time"])
 
-    pc_sorted = [doc for doc in db.sanjose.aggregate([{"$match":{"address.postcode":{"$exists":1}}}, 
-                                      {"$group":{"_id":"$address.postcode", "count":{"$sum":1}}}, 
-                                      {"$sort":{"count":-1}}])]
     print
     print "Most used postcodes..."
-    pprint.pprint(pc_sorted)
-
+    pprint.pprint(report["pc_sorted"])
 
-    top10_amenities = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1}}}, 
-                                         {"$group":{"_id":"$amenity", "count":{"$sum":1}}}, 
-                                         {"$sort":{"count":-1}}, 
-                                         {"$limit":10}])]
     print
     print "top 10 amenities..."
-    pprint.pprint(top10_amenities)
+    pprint.pprint(report["top10_amenities"])
 
-    
-    all_univ = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1}, "name":{"$exists":1}, "amenity":"university"}},
-                                          {"$group":{"_id":"$name", "count":{"$sum":1}}},
-                                          {"$sort":{"count":-1}}])]
     print
     print "All univ..."
-    pprint.pprint(all_univ)
+    pprint.pprint(report["all_univ"])
 
-    biggest_religion = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1}, "amenity":"place_of_worship"}},
-                                          {"$group":{"_id":"$religion", "count":{"$sum":1}}},
-                                          {"$sort":{"count":-1}}, {"$limit":1}])]
     print
     print "biggest religion..."
-    pprint.pprint(biggest_religion)
+    pprint.pprint(report["biggest_religion"])
 
-    popular_cuisines = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1},
-                                                                        "cuisine":{"$exists":1}, 
-                                                                        "amenity":"restaurant"}}, 
-                                        {"$group":{"_id":"$cuisine", "count":{"$sum":1}}},        
-                                        {"$sort":{"count":-1}}])]
     print
     print "popular cuisines..."
-    pprint.pprint(popular_cuisines)
+    pprint.pprint(report["popular_cuisines"])
 
-    indian_cuisines = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1},
-                                                                        "cuisine":"indian", 
-                                                                        "amenity":"restaurant"}}, 
-                                        {"$group":{"_id":"$name", "count":{"$sum":1}}},        
-                                        {"$sort":{"count":-1}}])]
     print
-    print "indian cuisines... total: ", db.sanjose.find({"cuisine":"indian", "amenity":"restaurant"}).count()
-    pprint.pprint(indian_cuisines)
+    print "indian cuisines... total: ", report["num_indian"]
+    pprint.pprint(report["indian_cuisines"])
+
+    # only the cached aggregates that involve this document are updated
+    update_document(db, {"name": "L&L Hawaiian BBQ"}, {"cuisine": "American"})
+    report = cached_report(db)
 
-    ll = db.sanjose.find_one({"name": "L&L Hawaiian BBQ"})
-    ll['cuisine'] = "American"
-    db.sanjose.save(ll)
-    
-    indian_cuisines = [doc for doc in db.sanjose.aggregate([{"$match":{"amenity":{"$exists":1},
-                                                                        "cuisine":"indian", 
-                                                                        "amenity":"restaurant"}}, 
-                                        {"$group":{"_id":"$name", "count":{"$sum":1}}},        
-                                        {"$sort":{"count":-1}}])]
     print
-    print "indian cuisines... total: ", db.sanjose.find({"cuisine":"indian", "amenity":"restaurant"}).count()
-    pprint.pprint(indian_cuisines)
+    print "indian cuisines... total: ", report["num_indian"]
+    pprint.pprint(report["indian_cuisines"])
 
 
 def test():
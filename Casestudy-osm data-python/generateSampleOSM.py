@@ -3,6 +3,8 @@
 
 import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
 
+from osminput import open_osm
+
 OSM_FILE = "san-jose_california.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
@@ -14,12 +16,13 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    with open_osm(osm_file) as osm:
+        context = iter(ET.iterparse(osm, events=('start', 'end')))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
 
 
 with open(SAMPLE_FILE, 'wb') as output:
@@ -13,16 +13,19 @@ Note that your code will be tested with a different data file than the 'example.
 import xml.etree.cElementTree as ET
 import pprint
 
+from osminput import open_osm
+
 def count_tags(filename):
     # YOUR CODE HERE
     tags = {}
-    parser = ET.iterparse(filename)
-    for ignore, elem in parser:
-        print elem.tag
-        if elem.tag in tags:
-            tags[elem.tag] += 1
-        else:
-            tags[elem.tag] = 1
+    with open_osm(filename) as osm:
+        parser = ET.iterparse(osm)
+        for ignore, elem in parser:
+            print elem.tag
+            if elem.tag in tags:
+                tags[elem.tag] += 1
+            else:
+                tags[elem.tag] = 1
     return tags
 
 def test():
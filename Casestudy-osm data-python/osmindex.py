@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import xml.etree.cElementTree as ET
+import xml.parsers.expat
+import os
+import sys
+import mmap
+import struct
+import bisect
+import pprint
+from array import array
+"""
+Random access into a raw .osm file by element id.
+
+build_index scans the map file once and records, for every top level node, way
+and relation, its id, the byte offset of its opening tag and its length in
+bytes. The result is written next to the map file as '<file>.idx':
+
+    8 bytes   magic "OSMIDX2\\n"
+    8 bytes   size of the map file
+    8 bytes   modification time of the map file, in microseconds
+    per type (node, way, relation):
+        8 bytes   number of elements n
+        n x 8     ids, sorted
+        n x 8     byte offsets
+        n x 8     lengths
+
+(integers are 64 bit, native byte order). An index whose recorded size or
+modification time no longer matches the map file (the extract was replaced or
+downloaded again) is rebuilt when OsmIndex opens it. The offsets come from
+expat, so comments, CDATA and '>' inside attribute values are handled like any
+xml parser would, and a map file that is not well formed (e.g. truncated in
+the middle of an element) raises ValueError instead of being indexed.
+
+OsmIndex memory maps both the index and the map file, finds an id with a
+binary search over the mapped ids and slices the raw xml straight out of the
+map file, so a lookup costs a couple of microseconds and loading the index
+costs nothing:
+
+    index = OsmIndex('san-jose_california.osm')
+    index.raw('node', '261114295')      # the xml of the element
+    index.shape('way', '5001')          # finalProject.shape_element of it
+    index.way_nodes('5001')             # all node_refs of the way, batched
+"""
+
+TYPES = ("node", "way", "relation")
+MAGIC = "OSMIDX2\n"
+STAMP = struct.Struct("=2q")
+CHUNK_SIZE = 1 << 20
+
+
+def _int64_array():
+    """ array of 64 bit signed integers ('q' where available, 'l' on 64 bit python 2) """
+    for typecode in ('q', 'l'):
+        try:
+            a = array(typecode)
+        except ValueError:
+            continue
+        if a.itemsize == 8:
+            return a
+    raise RuntimeError("no 64 bit array type available")
+
+
+def index_file(osmfile):
+    return "{0}.idx".format(osmfile)
+
+
+def file_stamp(osmfile):
+    """ (size, mtime in microseconds) of the map file, recorded in the index """
+    st = os.stat(osmfile)
+    return st.st_size, int(st.st_mtime * 1000000)
+
+
+def read_stamp(index):
+    """ The (size, mtime) recorded in an index file, None if it is not a current index """
+    with open(index, "rb") as f:
+        header = f.read(len(MAGIC) + STAMP.size)
+    if len(header) < len(MAGIC) + STAMP.size or header[:len(MAGIC)] != MAGIC:
+        return None
+    return STAMP.unpack_from(header, len(MAGIC))
+
+
+def scan_elements(data):
+    """ Yield (type, id, offset, length) for each top level element in the mapped file """
+    parser = xml.parsers.expat.ParserCreate()
+    found = []
+    state = {"depth": 0}
+
+    def start_element(name, attrs):
+        state["depth"] += 1
+        if state["depth"] == 2 and name in TYPES:
+            state["element"] = (name, int(attrs['id']), parser.CurrentByteIndex)
+
+    def end_element(name):
+        state["depth"] -= 1
+        if state["depth"] == 1 and name in TYPES:
+            kind, ident, offset = state.pop("element")
+            end = parser.CurrentByteIndex
+            if data[end:end + 2] == "</":
+                end = data.find(">", end) + 1
+            # else an empty element: with a start handler set, expat reports
+            # its end event at the end of the tag
+            found.append((kind, ident, offset, end - offset))
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    try:
+        for pos in xrange(0, len(data), CHUNK_SIZE):
+            parser.Parse(data[pos:pos + CHUNK_SIZE], False)
+            for entry in found:
+                yield entry
+            del found[:]
+        parser.Parse("", True)
+    except xml.parsers.expat.ExpatError as e:
+        raise ValueError("not a well formed map file: {0}".format(e))
+    for entry in found:
+        yield entry
+
+
+def build_index(osmfile, out=None):
+    """ Scan 'osmfile' and write the sorted id -> (offset, length) arrays """
+    columns = dict((kind, (_int64_array(), _int64_array(), _int64_array())) for kind in TYPES)
+    stamp = file_stamp(osmfile)
+    with open(osmfile, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for kind, ident, offset, length in scan_elements(data):
+                ids, offsets, lengths = columns[kind]
+                ids.append(ident)
+                offsets.append(offset)
+                lengths.append(length)
+        finally:
+            data.close()
+
+    out = out or index_file(osmfile)
+    with open(out, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(STAMP.pack(*stamp))
+        for kind in TYPES:
+            ids, offsets, lengths = columns[kind]
+            if any(ids[i] > ids[i + 1] for i in xrange(len(ids) - 1)):
+                order = sorted(xrange(len(ids)), key=ids.__getitem__)
+                for column in (ids, offsets, lengths):
+                    column[:] = array(column.typecode, [column[i] for i in order])
+            fo.write(struct.pack("=q", len(ids)))
+            for column in (ids, offsets, lengths):
+                column.tofile(fo)
+    return dict((kind, len(columns[kind][0])) for kind in TYPES)
+
+
+class _Column(object):
+    """ Read only sequence of 64 bit integers inside a memory map """
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from("=q", self.buf, self.offset + 8 * i)[0]
+
+
+class OsmIndex(object):
+    """ Memory mapped id -> raw xml lookups into a map file """
+
+    def __init__(self, osmfile, index=None):
+        index = index or index_file(osmfile)
+        if not os.path.exists(index) or read_stamp(index) != file_stamp(osmfile):
+            build_index(osmfile, index)
+        self._osm = open(osmfile, "rb")
+        self._idx = open(index, "rb")
+        self.data = mmap.mmap(self._osm.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = mmap.mmap(self._idx.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.buf[:len(MAGIC)] == MAGIC, "not an osm index: {0}".format(index)
+
+        self.columns = {}
+        pos = len(MAGIC) + STAMP.size
+        for kind in TYPES:
+            n = struct.unpack_from("=q", self.buf, pos)[0]
+            pos += 8
+            self.columns[kind] = [_Column(self.buf, pos + 8 * n * i, n) for i in range(3)]
+            pos += 24 * n
+
+    def close(self):
+        self.data.close()
+        self.buf.close()
+        self._osm.close()
+        self._idx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return sum(len(self.columns[kind][0]) for kind in TYPES)
+
+    def _find(self, kind, ident, lo=0):
+        ids = self.columns[kind][0]
+        i = bisect.bisect_left(ids, int(ident), lo)
+        if i < len(ids) and ids[i] == int(ident):
+            return i
+        return None
+
+    def locate(self, kind, ident):
+        """ (offset, length) of the element, or None """
+        i = self._find(kind, ident)
+        if i is None:
+            return None
+        _, offsets, lengths = self.columns[kind]
+        return offsets[i], lengths[i]
+
+    def raw(self, kind, ident):
+        """ The raw xml of the element, or None """
+        loc = self.locate(kind, ident)
+        if loc is None:
+            return None
+        return self.data[loc[0]:loc[0] + loc[1]]
+
+    def element(self, kind, ident):
+        raw = self.raw(kind, ident)
+        return None if raw is None else ET.fromstring(raw)
+
+    def shape(self, kind, ident, shape_element=None):
+        """ The shaped document of the element, as process_map would produce it """
+        if shape_element is None:
+            from finalProject import shape_element
+        element = self.element(kind, ident)
+        return None if element is None else shape_element(element)
+
+    def raw_many(self, kind, idents):
+        """ Batched lookup: {id: raw xml or None}, resolved in id order """
+        _, offsets, lengths = self.columns[kind]
+        found = {}
+        lo = 0
+        for ident in sorted(set(idents), key=int):
+            i = self._find(kind, ident, lo)
+            if i is None:
+                found[ident] = None
+            else:
+                found[ident] = self.data[offsets[i]:offsets[i] + lengths[i]]
+                lo = i
+        return found
+
+    def way_nodes(self, way_id):
+        """ Raw xml of every node in the node_refs of a way, in way order """
+        way = self.element("way", way_id)
+        if way is None:
+            return None
+        refs = [nd.attrib['ref'] for nd in way.iter("nd")]
+        found = self.raw_many("node", refs)
+        return [(ref, found[ref]) for ref in refs]
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "build":
+        pprint.pprint(build_index(sys.argv[2]))
+    elif len(sys.argv) == 5 and sys.argv[1] in ("raw", "shape"):
+        with OsmIndex(sys.argv[2]) as index:
+            if sys.argv[1] == "raw":
+                print index.raw(sys.argv[3], sys.argv[4])
+            else:
+                pprint.pprint(index.shape(sys.argv[3], sys.argv[4]))
+    else:
+        print "usage: osmindex.py build <file.osm>"
+        print "       osmindex.py raw|shape <file.osm> node|way|relation <id>"
+
+
+def test():
+    import mapparser
+    import finalProject
+    counts = build_index('example.osm')
+    tags = mapparser.count_tags('example.osm')
+    assert counts == dict((kind, tags.get(kind, 0)) for kind in TYPES)
+
+    shaped = dict((el['id'], el) for el in finalProject.process_map('example.osm'))
+    with OsmIndex('example.osm') as index:
+        assert len(index) == sum(counts.values())
+        for ident, el in shaped.items():
+            assert index.shape(el['type'], ident) == el
+        assert index.raw("node", "0") is None
+        way = [el for el in shaped.values() if el['type'] == "way"][0]
+        nodes = index.way_nodes(way['id'])
+        assert [ref for ref, _ in nodes] == way['node_refs']
+        pprint.pprint(nodes[:2])
+
+    # a changed map file makes the index stale: it is rebuilt
+    os.utime('example.osm', None)
+    os.utime('example.osm.idx', (0, 0))
+    stale = read_stamp('example.osm.idx')
+    with OsmIndex('example.osm') as index:
+        assert read_stamp('example.osm.idx') == file_stamp('example.osm') != stale
+        assert len(index) == sum(counts.values())
+
+    try:
+        list(scan_elements('<osm><way id="1"><nd ref="2"/>'))
+        assert False, "truncated element was indexed"
+    except ValueError:
+        pass
+
+    # a commented out node is not indexed, a '>' in an attribute does not end the tag
+    tricky = ('<osm>\n <!-- <node id="5"/> -->\n <node id="1" user="a>b"/>\n'
+              ' <node id="2" lat="1"><tag k="a" v="b"/></node >\n</osm>\n')
+    entries = list(scan_elements(tricky))
+    assert [(kind, ident) for kind, ident, _, _ in entries] == [("node", 1), ("node", 2)]
+    assert [tricky[offset:offset + length] for _, _, offset, length in entries] == \
+        ['<node id="1" user="a>b"/>', '<node id="2" lat="1"><tag k="a" v="b"/></node >']
+
+
+if __name__ == "__main__":
+    main()
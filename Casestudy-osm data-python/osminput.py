@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import mmap
+import time
+import Queue
+import threading
+import pprint
+"""
+Shared input layer for the scripts that parse the map file.
+
+process_map, count_tags, audit, the sampler and the other streaming tools open
+the map file with open_osm instead of open() / a path, and hand the file object
+to ET.iterparse. open_osm offers:
+
+- "buffered": a plain read with a large buffer (settings["buffer_size"],
+  4 MB by default) instead of the small default chunks
+- "mmap": the file is memory mapped, reads are slices of the mapping
+  (local files only)
+- read_ahead: a background thread keeps up to settings["read_ahead_chunks"]
+  chunks of settings["buffer_size"] bytes read in advance, so the parser
+  does not wait on a slow (e.g. network attached) volume
+
+Every reader counts the bytes it delivers and the time spent waiting inside
+read(). When the file is closed its stats are kept in last_stats (and printed
+on stderr with settings["report"]): if the read wait is a large part of the
+elapsed time the run is limited by I/O, otherwise by the parsing.
+
+The settings can be changed with configure() or, without editing any code,
+with the environment variables OSM_INPUT_MODE (buffered / mmap),
+OSM_INPUT_BUFFER (bytes), OSM_INPUT_READ_AHEAD (number of chunks, 0 = off)
+and OSM_INPUT_REPORT (1 to print the stats).
+"""
+
+settings = {"mode": os.environ.get("OSM_INPUT_MODE", "buffered"),
+            "buffer_size": int(os.environ.get("OSM_INPUT_BUFFER", 4 * 1024 * 1024)),
+            "read_ahead_chunks": int(os.environ.get("OSM_INPUT_READ_AHEAD", 0)),
+            "report": os.environ.get("OSM_INPUT_REPORT", "") == "1"}
+
+last_stats = None
+
+
+def configure(**kwargs):
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError("unknown input setting: {0}".format(key))
+        settings[key] = value
+
+
+class MmapFile(object):
+    """ read() / close() over a memory mapped file """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._pos = 0
+
+    def read(self, n=-1):
+        if self._map is None:
+            return b""
+        end = len(self._map) if n is None or n < 0 else min(self._pos + n, len(self._map))
+        data = self._map[self._pos:end]
+        self._pos = end
+        return data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+class ReadAhead(object):
+    """ A thread reads the next chunks of 'source' while the caller consumes the current one """
+
+    def __init__(self, source, chunk_size, depth):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._chunks = Queue.Queue(maxsize=depth)
+        self._stop = False
+        self._chunk = b""
+        self._pos = 0
+        self._eof = False
+        self._error = None
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop:
+                chunk = self._source.read(self._chunk_size)
+                self._chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._error = e
+            self._chunks.put(b"")
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            parts = []
+            while True:
+                part = self.read(self._chunk_size)
+                if not part:
+                    return b"".join(parts)
+                parts.append(part)
+        while self._pos >= len(self._chunk):
+            if self._eof:
+                return b""
+            self._chunk = self._chunks.get()
+            self._pos = 0
+            if not self._chunk:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return b""
+        data = self._chunk[self._pos:self._pos + n]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._stop = True
+        while self._thread.is_alive():
+            try:
+                self._chunks.get(timeout=0.01)
+            except Queue.Empty:
+                pass
+        self._source.close()
+
+
+class OsmInput(object):
+    """ File object handed to the parsers: counts bytes and read time """
+
+    def __init__(self, path, reader, mode):
+        self.name = path
+        self._reader = reader
+        self.mode = mode
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.opened = time.time()
+        self.closed = False
+
+    def read(self, n=-1):
+        start = time.time()
+        data = self._reader.read(n)
+        self.read_seconds += time.time() - start
+        self.bytes += len(data)
+        return data
+
+    def stats(self):
+        elapsed = time.time() - self.opened
+        return {"file": self.name,
+                "mode": self.mode,
+                "bytes": self.bytes,
+                "elapsed_seconds": elapsed,
+                "read_seconds": self.read_seconds,
+                "mb_per_second": self.bytes / 1e6 / max(elapsed, 1e-9),
+                "read_mb_per_second": self.bytes / 1e6 / max(self.read_seconds, 1e-9),
+                "read_fraction": self.read_seconds / max(elapsed, 1e-9)}
+
+    def close(self):
+        global last_stats
+        if self.closed:
+            return
+        self.closed = True
+        self._reader.close()
+        last_stats = self.stats()
+        if settings["report"]:
+            sys.stderr.write("input {file}: {bytes} bytes, {mb_per_second:.1f} MB/s, "
+                             "{read_fraction:.0%} of the time waiting on reads\n".format(**last_stats))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_osm(path, mode=None, buffer_size=None, read_ahead_chunks=None):
+    """ Open a map file for parsing, see the module docstring for the options """
+    mode = mode or settings["mode"]
+    buffer_size = buffer_size or settings["buffer_size"]
+    if read_ahead_chunks is None:
+        read_ahead_chunks = settings["read_ahead_chunks"]
+
+    if mode == "mmap":
+        reader = MmapFile(path)
+    elif mode == "buffered":
+        reader = io.open(path, "rb", buffering=buffer_size)
+    else:
+        raise ValueError("unknown input mode: {0}".format(mode))
+    if read_ahead_chunks:
+        reader = ReadAhead(reader, buffer_size, read_ahead_chunks)
+        mode += "+read_ahead"
+    return OsmInput(path, reader, mode)
+
+
+def test():
+    import xml.etree.cElementTree as ET
+    with open('example.osm', "rb") as f:
+        expected = f.read()
+    for mode in ("buffered", "mmap"):
+        for read_ahead in (0, 3):
+            with open_osm('example.osm', mode, 1024, read_ahead) as f:
+                data = b""
+                while True:
+                    chunk = f.read(777)
+                    if not chunk:
+                        break
+                    data += chunk
+            assert data == expected, mode
+            assert last_stats["bytes"] == len(expected)
+            with open_osm('example.osm', mode, 4096, read_ahead) as f:
+                count = sum(1 for _ in ET.iterparse(f))
+            assert count > 0
+            pprint.pprint(last_stats)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import json
+import resource
+import cProfile
+import pstats
+import StringIO
+import importlib
+import argparse
+import pprint
+from collections import defaultdict
+"""
+Opt-in instrumentation for the wrangling scripts.
+
+The functions of a module (finalProject, data, audit, tags, users, mapparser)
+are swapped for timed wrappers while a run is in progress, so nothing has to be
+edited in the scripts themselves. For every stage we record the number of calls,
+the wall clock time and the CPU time. The stages are:
+
+- "iterparse": time spent pulling the next element out of ET.iterparse
+- the module level functions listed in STAGES, e.g. "shape_element",
+  "update_name", "update_post_codes"
+- "json.dumps": serialising the shaped documents
+- "write": writing to the output file opened with codecs.open
+
+Every 'snapshot_every' parsed elements a memory snapshot is taken (peak RSS,
+and the tracemalloc current/peak size and top allocations when tracemalloc is
+available). The whole run can optionally be wrapped in cProfile.
+
+The result is a plain dictionary that can be dumped as json, for example:
+
+    python profiler.py finalProject process_map san-jose_california.osm --out summary.json
+"""
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+process_time = getattr(time, 'process_time', time.clock)
+
+STAGES = ["shape_element", "update_name", "update_street_name", "update_post_codes",
+          "update_node_refs", "get_lat_long", "audit_street_type", "key_type", "get_user"]
+
+
+class StageTimer(object):
+    """ Accumulate calls, wall time and cpu time per stage """
+
+    def __init__(self, snapshot_every=0):
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0])
+        self.snapshot_every = snapshot_every
+        self.snapshots = []
+        self.elements = 0
+        self.started = time.time()
+
+    def add(self, name, wall, cpu):
+        stage = self.stages[name]
+        stage[0] += 1
+        stage[1] += wall
+        stage[2] += cpu
+
+    def wrap(self, name, func):
+        """ Return a version of 'func' whose calls are counted under 'name' """
+        def timed(*args, **kwargs):
+            wall, cpu = time.time(), process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - wall, process_time() - cpu)
+        timed.__name__ = getattr(func, '__name__', name)
+        timed.__wrapped__ = func
+        return timed
+
+    def iterate(self, name, iterable):
+        """ Yield from 'iterable', timing each step and taking the memory snapshots """
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.time(), process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.time() - wall, process_time() - cpu)
+            self.elements += 1
+            if self.snapshot_every and self.elements % self.snapshot_every == 0:
+                self.snapshot()
+            yield item
+
+    def snapshot(self):
+        """ Record the memory use at this point of the run """
+        snap = {"elements": self.elements,
+                "elapsed": time.time() - self.started,
+                "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snap["traced_current"] = current
+            snap["traced_peak"] = peak
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            snap["top_allocations"] = [[str(stat.traceback), stat.size] for stat in top]
+        self.snapshots.append(snap)
+
+    def summary(self):
+        stages = {}
+        for name, (calls, wall, cpu) in self.stages.items():
+            stages[name] = {"calls": calls, "wall": wall, "cpu": cpu}
+        return {"elapsed": time.time() - self.started,
+                "elements": self.elements,
+                "stages": stages,
+                "snapshots": self.snapshots}
+
+
+class _Proxy(object):
+    """ Stand-in for a module (ET, json, codecs) with some attributes replaced """
+
+    def __init__(self, target, **overrides):
+        self._target = target
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+class _TimedFile(object):
+    """ File wrapper that times the writes """
+
+    def __init__(self, fo, timer):
+        self._fo = fo
+        self.write = timer.wrap("write", fo.write)
+
+    def __getattr__(self, name):
+        return getattr(self._fo, name)
+
+    def __enter__(self):
+        self._fo.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._fo.__exit__(*exc)
+
+
+def instrument(module, timer):
+    """ Swap the stages of 'module' for timed versions, return what is needed to restore it """
+    saved = {}
+
+    def patch(name, value):
+        saved[name] = getattr(module, name)
+        setattr(module, name, value)
+
+    for name in STAGES:
+        if callable(getattr(module, name, None)):
+            patch(name, timer.wrap(name, getattr(module, name)))
+
+    if hasattr(module, 'ET'):
+        ET = module.ET
+        patch('ET', _Proxy(ET, iterparse=lambda *args, **kwargs:
+                           timer.iterate("iterparse", ET.iterparse(*args, **kwargs))))
+    if hasattr(module, 'json'):
+        patch('json', _Proxy(module.json, dumps=timer.wrap("json.dumps", module.json.dumps)))
+    if hasattr(module, 'codecs'):
+        codecs = module.codecs
+        patch('codecs', _Proxy(codecs, open=lambda *args, **kwargs:
+                               _TimedFile(codecs.open(*args, **kwargs), timer)))
+    return saved
+
+
+def restore(module, saved):
+    """ Undo instrument() """
+    for name, value in saved.items():
+        setattr(module, name, value)
+
+
+def profile_run(module, func_name, args=(), snapshot_every=10000, use_cprofile=False,
+                trace_memory=False):
+    """ Run module.func_name(*args) with the stages instrumented and return the summary """
+    timer = StageTimer(snapshot_every)
+    saved = instrument(module, timer)
+    profiler = cProfile.Profile() if use_cprofile else None
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        if profiler:
+            profiler.enable()
+        getattr(module, func_name)(*args)
+    finally:
+        if profiler:
+            profiler.disable()
+        restore(module, saved)
+    timer.snapshot()
+    summary = timer.summary()
+    summary["module"] = module.__name__
+    summary["function"] = func_name
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.stop()
+    if profiler:
+        stream = StringIO.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+        summary["cprofile"] = stream.getvalue()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile one of the wrangling scripts")
+    parser.add_argument("module", help="e.g. finalProject, data, audit, tags, users")
+    parser.add_argument("function", help="e.g. process_map, audit, count_tags")
+    parser.add_argument("args", nargs="*", help="arguments passed to the function")
+    parser.add_argument("--snapshot-every", type=int, default=10000,
+                        help="take a memory snapshot every N parsed elements (0 = only at the end)")
+    parser.add_argument("--cprofile", action="store_true", help="also wrap the run in cProfile")
+    parser.add_argument("--tracemalloc", action="store_true", help="trace allocations (python 3)")
+    parser.add_argument("--out", help="write the json summary here instead of stdout")
+    options = parser.parse_args()
+
+    module = importlib.import_module(options.module)
+    summary = profile_run(module, options.function, options.args, options.snapshot_every,
+                          options.cprofile, options.tracemalloc)
+    if options.out:
+        with open(options.out, "w") as fo:
+            json.dump(summary, fo, indent=2)
+    else:
+        print json.dumps(summary, indent=2)
+
+
+def test():
+    import finalProject
+    summary = profile_run(finalProject, "process_map", ('example.osm',), snapshot_every=5)
+    pprint.pprint(summary["stages"])
+    assert summary["stages"]["shape_element"]["calls"] == summary["stages"]["iterparse"]["calls"]
+    assert summary["stages"]["write"]["calls"] > 0
+    assert len(summary["snapshots"]) > 1
+    assert finalProject.shape_element.__name__ == "shape_element"
+    assert not hasattr(finalProject.shape_element, '__wrapped__')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import bisect
+import pprint
+from array import array
+
+from sketches import get_elements
+"""
+Referential integrity of the way node_refs.
+
+Nothing checks that the ids collected by update_node_refs exist among the
+nodes of the extract, and the every k-th element sample from
+generateSampleOSM breaks this all the time. check_map streams the map file
+once and reports:
+
+- dangling refs: node_refs (and relation node members) that point to nodes
+  missing from the file
+- orphan nodes: nodes that no way or relation refers to; the untagged ones
+  are counted separately since a tagged node is usually a point of interest
+
+Node ids are kept in an IdSet instead of a Python set of strings. Ids are split
+in chunks of 65536; a chunk holds a sorted array of 16 bit offsets while it has
+few ids and turns into an 8 KB bitmap once it has more than 4096 of them
+(the layout of roaring bitmaps). That is 2 bytes per id in sparse areas and at
+most 1 bit per possible id in dense ones, so tens of millions of ids fit in a
+few hundred MB at worst, against 60+ bytes per id for a set of strings.
+
+OSM files list the nodes before the ways, so a ref that is missing when its
+way is read is dangling for good: only the counts, the distinct missing ids (in
+an IdSet) and MAX_EXAMPLES examples are kept. If a node does come after a way,
+the refs are checked again in a second pass against the complete node set.
+With shape=finalProject.shape_element only the elements that survive the
+shaping are counted and the refs are taken from the shaped node_refs.
+"""
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+ARRAY_LIMIT = 4096
+BITMAP_BYTES = (1 << CHUNK_BITS) // 8
+MAX_EXAMPLES = 20
+
+
+class IdSet(object):
+    """ Compact set of integer ids: sorted arrays for sparse chunks, bitmaps for dense ones """
+
+    def __init__(self):
+        self.chunks = {}
+        self.count = 0
+
+    def add(self, ident):
+        key, low = ident >> CHUNK_BITS, ident & CHUNK_MASK
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = array('H')
+        if isinstance(chunk, array):
+            if not chunk or low > chunk[-1]:
+                chunk.append(low)
+            else:
+                i = bisect.bisect_left(chunk, low)
+                if i < len(chunk) and chunk[i] == low:
+                    return
+                chunk.insert(i, low)
+            self.count += 1
+            if len(chunk) > ARRAY_LIMIT:
+                bitmap = bytearray(BITMAP_BYTES)
+                for v in chunk:
+                    bitmap[v >> 3] |= 1 << (v & 7)
+                self.chunks[key] = bitmap
+        else:
+            bit = 1 << (low & 7)
+            if not chunk[low >> 3] & bit:
+                chunk[low >> 3] |= bit
+                self.count += 1
+
+    def __contains__(self, ident):
+        chunk = self.chunks.get(ident >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = ident & CHUNK_MASK
+        if isinstance(chunk, array):
+            i = bisect.bisect_left(chunk, low)
+            return i < len(chunk) and chunk[i] == low
+        return bool(chunk[low >> 3] & (1 << (low & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ The ids in increasing order """
+        for key in sorted(self.chunks):
+            chunk = self.chunks[key]
+            base = key << CHUNK_BITS
+            if isinstance(chunk, array):
+                for low in chunk:
+                    yield base + low
+            else:
+                for byte, bits in enumerate(chunk):
+                    if bits:
+                        for b in range(8):
+                            if bits & (1 << b):
+                                yield base + (byte << 3) + b
+
+    def nbytes(self):
+        """ Approximate size of the chunk payloads """
+        return sum(len(c) * (c.itemsize if isinstance(c, array) else 1)
+                   for c in self.chunks.values())
+
+
+class DanglingRefs(object):
+    """ Counts of the refs missing from a node set, the distinct missing ids and a few examples """
+
+    def __init__(self):
+        self.refs = 0
+        self.elements = 0
+        self.ids = IdSet()
+        self.examples = []
+
+    def check(self, element, refs, nodes):
+        missing = [ref for ref in refs if ref not in nodes]
+        if not missing:
+            return
+        self.elements += 1
+        self.refs += len(missing)
+        for ref in missing:
+            self.ids.add(ref)
+            if len(self.examples) < MAX_EXAMPLES:
+                self.examples.append((element.tag, element.attrib['id'], ref))
+
+
+def shaped_elements(filename, shape=None):
+    """ Yield (element, shaped document) for the elements that survive 'shape' """
+    for element in get_elements(filename):
+        doc = None
+        if shape is not None:
+            doc = shape(element)
+            if not doc:
+                continue
+        yield element, doc
+
+
+def element_refs(element, doc=None):
+    """ The node ids a way (its node_refs) or a relation (its node members) refers to """
+    if element.tag == "way":
+        if doc is not None:
+            refs = doc.get('node_refs', [])
+        else:
+            refs = [nd.attrib['ref'] for nd in element.iter("nd")]
+    else:
+        refs = [m.attrib['ref'] for m in element.iter("member") if m.attrib.get('type') == "node"]
+    return [int(ref) for ref in refs]
+
+
+def check_map(filename, shape=None):
+    """ Stream the map file and report dangling refs and orphan nodes """
+    nodes, tagged, referenced = IdSet(), IdSet(), IdSet()
+    dangling = DanglingRefs()
+    num_ways = num_refs = 0
+    seen_refs = late_nodes = False
+    for element, doc in shaped_elements(filename, shape):
+        if element.tag == "node":
+            ident = int(element.attrib['id'])
+            nodes.add(ident)
+            if element.find("tag") is not None:
+                tagged.add(ident)
+            late_nodes = late_nodes or seen_refs
+            continue
+
+        seen_refs = True
+        if element.tag == "way":
+            num_ways += 1
+        refs = element_refs(element, doc)
+        for ref in refs:
+            referenced.add(ref)
+        num_refs += len(refs)
+        dangling.check(element, refs, nodes)
+
+    if late_nodes:
+        # a node came after a way, refs that looked dangling may exist after all
+        dangling = DanglingRefs()
+        for element, doc in shaped_elements(filename, shape):
+            if element.tag != "node":
+                dangling.check(element, element_refs(element, doc), nodes)
+
+    orphans = orphans_untagged = 0
+    orphan_examples = []
+    for ident in nodes:
+        if ident not in referenced:
+            orphans += 1
+            if ident not in tagged:
+                orphans_untagged += 1
+                if len(orphan_examples) < MAX_EXAMPLES:
+                    orphan_examples.append(ident)
+
+    return {"nodes": len(nodes),
+            "ways": num_ways,
+            "refs": num_refs,
+            "dangling_refs": dangling.refs,
+            "dangling_nodes": len(dangling.ids),
+            "elements_with_dangling_refs": dangling.elements,
+            "dangling_examples": dangling.examples,
+            "orphan_nodes": orphans,
+            "orphan_untagged_nodes": orphans_untagged,
+            "orphan_untagged_examples": orphan_examples,
+            "memory_bytes": nodes.nbytes() + tagged.nbytes() + referenced.nbytes() + dangling.ids.nbytes()}
+
+
+def test():
+    import os
+    import tempfile
+    import xml.etree.cElementTree as ET
+    result = check_map('example.osm')
+    pprint.pprint(result)
+
+    node_ids, refs = set(), []
+    for _, elem in ET.iterparse('example.osm'):
+        if elem.tag == "node":
+            node_ids.add(int(elem.attrib['id']))
+        elif elem.tag == "nd" or (elem.tag == "member" and elem.attrib.get('type') == "node"):
+            refs.append(int(elem.attrib['ref']))
+    assert result["nodes"] == len(node_ids)
+    assert result["dangling_refs"] == len([r for r in refs if r not in node_ids])
+    assert result["orphan_nodes"] == len(node_ids - set(refs))
+    assert result["dangling_nodes"] == len(set(r for r in refs if r not in node_ids))
+    assert len(result["dangling_examples"]) == min(result["dangling_refs"], MAX_EXAMPLES)
+
+    # nodes after the ways: the second pass resolves the refs to them
+    fd, path = tempfile.mkstemp(suffix=".osm")
+    with os.fdopen(fd, "w") as fo:
+        fo.write('<osm><way id="9"><nd ref="1"/><nd ref="2"/></way>'
+                 '<node id="1" lat="0" lon="0"/></osm>')
+    try:
+        late = check_map(path)
+    finally:
+        os.remove(path)
+    assert (late["dangling_refs"], late["elements_with_dangling_refs"]) == (1, 1)
+    assert late["dangling_examples"] == [("way", "9", 2)]
+
+    # relation node members are references too
+    fd, path = tempfile.mkstemp(suffix=".osm")
+    with os.fdopen(fd, "w") as fo:
+        fo.write('<osm><node id="1" lat="0" lon="0"/><node id="2" lat="0" lon="0"/>'
+                 '<relation id="4"><member type="node" ref="1" role=""/>'
+                 '<member type="node" ref="3" role=""/><member type="way" ref="2" role=""/></relation></osm>')
+    try:
+        members = check_map(path)
+    finally:
+        os.remove(path)
+    assert (members["refs"], members["orphan_nodes"], members["dangling_refs"]) == (2, 1, 1)
+    assert members["dangling_examples"] == [("relation", "4", 3)]
+
+    ids = IdSet()
+    for i in range(0, 200000, 3) + [5, -7, 2 ** 40]:
+        ids.add(i)
+    assert len(ids) == len(set(range(0, 200000, 3) + [5, -7, 2 ** 40]))
+    assert 5 in ids and -7 in ids and 2 ** 40 in ids and 4 not in ids
+    assert list(ids) == sorted(set(range(0, 200000, 3) + [5, -7, 2 ** 40]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        pprint.pprint(check_map(sys.argv[1]))
+    else:
+        test()
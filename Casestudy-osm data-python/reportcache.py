@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import copy
+import time
+import pprint
+from collections import Counter
+"""
+Materialized results of the report in finalProject.query_and_update_data.
+
+Every report used to rerun all its aggregations even when the collection had
+not changed since the last load. Now:
+
+- the loaders (insert_data, insert_data_bulk, batch.load_region and
+  tiles.load_tiles) call bump_generation, which increments a load generation
+  counter kept in db.report_meta
+- cached_report returns the results stored in db.report_cache when they were
+  computed for the current generation, and recomputes and stores them otherwise
+- update_document applies a single document edit (like the L&L Hawaiian BBQ
+  cuisine fix, dotted fields like "address.postcode" set the nested field) and
+  patches the cached aggregates it affects, instead of invalidating the cache
+
+Every aggregate is its own document in db.report_cache ("<collection>:<name>"),
+so no single document grows with the data past MongoDB's 16 MB limit.
+
+Each aggregate in REPORT is a MongoDB $match query, optionally with the field to
+group by. The same query is evaluated in python on the old and the new version
+of an edited document (see matches), so an edit only moves one count from one
+group to another. Grouped aggregates are cached without their limit and the
+limits ("top 10", "biggest") are applied when the report is read, except for
+top_user: one group per user would not fit, so it is cached as the TOP_USERS
+biggest users plus the histogram of users per number of documents that
+user_1time is read from.
+"""
+
+# name: (match, group by field or None for a plain count, limit)
+REPORT = [
+    ("num_docs", {}, None, None),
+    ("num_nodes", {"type": "node"}, None, None),
+    ("num_ways", {"type": "way"}, None, None),
+    ("num_hospitals", {"amenity": "hospital"}, None, None),
+    ("num_schools", {"amenity": "school"}, None, None),
+    ("num_univ", {"amenity": "university"}, None, None),
+    ("top_user", {}, "created.user", 1),
+    ("pc_sorted", {"address.postcode": {"$exists": 1}}, "address.postcode", None),
+    ("top10_amenities", {"amenity": {"$exists": 1}}, "amenity", 10),
+    ("all_univ", {"name": {"$exists": 1}, "amenity": "university"}, "name", None),
+    ("biggest_religion", {"amenity": "place_of_worship"}, "religion", 1),
+    ("popular_cuisines", {"cuisine": {"$exists": 1}, "amenity": "restaurant"}, "cuisine", None),
+    ("indian_cuisines", {"cuisine": "indian", "amenity": "restaurant"}, "name", None),
+    ("num_indian", {"cuisine": "indian", "amenity": "restaurant"}, None, None),
+]
+
+MONGO_URI = "mongodb://localhost:27017"
+USER_REPORT = "top_user"
+TOP_USERS = 100
+
+
+def get_field(doc, path):
+    """ Value of a dotted field ("created.user") in a document, None if missing """
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def set_field(doc, path, value):
+    """ Set a dotted field ("address.postcode") in a document, creating the missing sub documents """
+    parts = path.split(".")
+    for part in parts[:-1]:
+        if part not in doc:
+            doc[part] = {}
+        elif not isinstance(doc[part], dict):
+            raise ValueError("can't set {0}: {1} is not a sub document".format(path, part))
+        doc = doc[part]
+    doc[parts[-1]] = value
+
+
+def matches(doc, query):
+    """ Python evaluation of the equality / $exists queries used in REPORT """
+    for path, condition in query.items():
+        value = get_field(doc, path)
+        if isinstance(condition, dict) and "$exists" in condition:
+            if (value is not None) != bool(condition["$exists"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def get_generation(db, collection="sanjose"):
+    meta = db.report_meta.find_one({"_id": collection})
+    return meta["generation"] if meta else 0
+
+
+def bump_generation(db, collection="sanjose"):
+    """ Called by the loaders: the cached report of 'collection' is now stale """
+    db.report_meta.update({"_id": collection}, {"$inc": {"generation": 1}}, upsert=True)
+
+
+def bump_generation_at(db_name, collection="sanjose", uri=MONGO_URI):
+    """ bump_generation over a new connection, for the loaders that only run mongoimport """
+    from pymongo import MongoClient
+    client = MongoClient(uri)
+    try:
+        bump_generation(client[db_name], collection)
+    finally:
+        client.close()
+
+
+def user_summary(counts):
+    """ The cached form of top_user, from {user: number of documents} """
+    top = sorted(counts.items(), key=lambda item: -item[1])[:TOP_USERS]
+    histogram = Counter(counts.values())
+    return {"top": [{"_id": user, "count": count} for user, count in top],
+            "histogram": [{"_id": c, "num_users": histogram[c]} for c in sorted(histogram)]}
+
+
+def compute_aggregate(coll, name, match, group):
+    """ Run one aggregate of REPORT, without its limit """
+    if group is None:
+        return coll.find(match).count()
+    by_group = [{"$match": match}, {"$group": {"_id": "$" + group, "count": {"$sum": 1}}}]
+    if name != USER_REPORT:
+        return [doc for doc in coll.aggregate(by_group + [{"$sort": {"count": -1}}])]
+    top = coll.aggregate(by_group + [{"$sort": {"count": -1}}, {"$limit": TOP_USERS}])
+    histogram = coll.aggregate(by_group + [{"$group": {"_id": "$count", "num_users": {"$sum": 1}}},
+                                           {"$sort": {"_id": 1}}])
+    return {"top": [doc for doc in top], "histogram": [doc for doc in histogram]}
+
+
+def compute_report(db, collection="sanjose"):
+    """ Run every aggregate of REPORT """
+    return dict((name, compute_aggregate(db[collection], name, match, group))
+                for name, match, group, _ in REPORT)
+
+
+def present(results):
+    """ The report as query_and_update_data prints it: limits applied, one time users added """
+    report = {}
+    for name, _, group, limit in REPORT:
+        value = results[name]
+        if name == USER_REPORT:
+            value = value["top"]
+        report[name] = value[:limit] if limit else value
+    report["user_1time"] = results[USER_REPORT]["histogram"][:1]
+    return report
+
+
+def cache_id(collection, name):
+    return "{0}:{1}".format(collection, name)
+
+
+def cached_aggregates(db, collection="sanjose"):
+    """ The cache documents of 'collection' that belong to the current generation, by name """
+    generation = get_generation(db, collection)
+    docs = db.report_cache.find({"collection": collection, "generation": generation})
+    return generation, dict((doc["name"], doc) for doc in docs)
+
+
+def cached_report(db, collection="sanjose"):
+    """ The report of 'collection'; aggregates are recomputed only if the collection was loaded since """
+    generation, cached = cached_aggregates(db, collection)
+    results = {}
+    for name, match, group, _ in REPORT:
+        doc = cached.get(name)
+        if doc is None:
+            doc = {"_id": cache_id(collection, name), "collection": collection, "name": name,
+                   "generation": generation, "computed_at": time.time(),
+                   "value": compute_aggregate(db[collection], name, match, group)}
+            db.report_cache.save(doc)
+        results[name] = doc["value"]
+    return present(results)
+
+
+def _move(groups, key, delta):
+    """ Add 'delta' to the count of group 'key' in a sorted [{"_id", "count"}] list """
+    for i, group in enumerate(groups):
+        if group["_id"] == key:
+            group["count"] += delta
+            if group["count"] <= 0:
+                del groups[i]
+            break
+    else:
+        if delta > 0:
+            groups.append({"_id": key, "count": delta})
+    groups.sort(key=lambda g: -g["count"])
+
+
+def _move_user(summary, user, delta, count):
+    """ Patch the top_user summary for a user whose number of documents changed by 'delta' to 'count'.
+    Returns False if the bounded top list can't be kept exact """
+    histogram = dict((h["_id"], h["num_users"]) for h in summary["histogram"])
+    if count - delta > 0:
+        histogram[count - delta] -= 1
+        if not histogram[count - delta]:
+            del histogram[count - delta]
+    if count > 0:
+        histogram[count] = histogram.get(count, 0) + 1
+    summary["histogram"] = [{"_id": c, "num_users": histogram[c]} for c in sorted(histogram)]
+
+    # while the list is not full it holds every user, otherwise no other user
+    # has more documents than the last one in the list
+    top = summary["top"]
+    full = len(top) >= TOP_USERS
+    floor = top[-1]["count"] if full else 0
+    others = [g for g in top if g["_id"] != user]
+    if len(others) < len(top) and full and count < floor:
+        return False
+    if len(others) < len(top) or count > floor or not full:
+        if count > 0:
+            others.append({"_id": user, "count": count})
+        others.sort(key=lambda g: -g["count"])
+        summary["top"] = others[:TOP_USERS]
+    return True
+
+
+def apply_edit(results, old, new, user_count):
+    """ Patch the cached aggregates in 'results' for a document that changed from 'old' to 'new'.
+
+    user_count(user) gives the number of documents of a user after the edit.
+    Returns the names of the aggregates that could not be patched """
+    stale = set()
+    for name, match, group, _ in REPORT:
+        if name not in results:
+            continue
+        before, after = matches(old, match), matches(new, match)
+        if group is None:
+            results[name] += int(after) - int(before)
+        elif before != after or get_field(old, group) != get_field(new, group):
+            moves = []
+            if before:
+                moves.append((get_field(old, group), -1))
+            if after:
+                moves.append((get_field(new, group), 1))
+            for key, delta in moves:
+                if name != USER_REPORT:
+                    _move(results[name], key, delta)
+                elif not _move_user(results[name], key, delta, user_count(key)):
+                    stale.add(name)
+    return stale
+
+
+def update_document(db, query, changes, collection="sanjose"):
+    """ Apply 'changes' to the first document matching 'query', keeping the cached report current.
+    Dotted keys ("address.postcode") set the nested field """
+    coll = db[collection]
+    old = coll.find_one(query)
+    if old is None:
+        return None
+    new = copy.deepcopy(old)
+    for path, value in changes.items():
+        set_field(new, path, value)
+    coll.save(new)
+
+    _, cached = cached_aggregates(db, collection)
+    if cached:
+        results = dict((name, doc["value"]) for name, doc in cached.items())
+        stale = apply_edit(results, old, new,
+                           lambda user: coll.find({"created.user": user}).count())
+        for name, doc in cached.items():
+            if name in stale:
+                db.report_cache.remove({"_id": doc["_id"]})
+            else:
+                doc["value"] = results[name]
+                db.report_cache.save(doc)
+    return new
+
+
+def test():
+    docs = [{"type": "node", "amenity": "restaurant", "cuisine": "indian", "name": "L&L Hawaiian BBQ",
+             "created": {"user": "a"}},
+            {"type": "node", "amenity": "restaurant", "cuisine": "indian", "name": "Amber India",
+             "created": {"user": "a"}},
+            {"type": "way", "amenity": "school", "created": {"user": "b"}}]
+
+    def compute(docs):
+        results = {}
+        for name, match, group, _ in REPORT:
+            selected = [d for d in docs if matches(d, match)]
+            if group is None:
+                results[name] = len(selected)
+            elif name == USER_REPORT:
+                results[name] = user_summary(Counter(get_field(d, group) for d in selected))
+            else:
+                results[name] = []
+                for d in selected:
+                    _move(results[name], get_field(d, group), 1)
+        return results
+
+    def user_count(user):
+        return len([d for d in docs if d["created"]["user"] == user])
+
+    results = compute(docs)
+    new = copy.deepcopy(docs[0])
+    set_field(new, "cuisine", "American")
+    set_field(new, "address.postcode", "95112")
+    assert new["address"] == {"postcode": "95112"} and "address.postcode" not in new
+    assert apply_edit(results, docs[0], new, user_count) == set()
+    docs[0] = new
+    report = present(results)
+    pprint.pprint(report)
+    assert report["num_indian"] == 1
+    assert report["indian_cuisines"] == [{"_id": "Amber India", "count": 1}]
+    assert report["popular_cuisines"] == [{"_id": "indian", "count": 1}, {"_id": "American", "count": 1}]
+    assert report["top_user"] == [{"_id": "a", "count": 2}]
+    assert report["user_1time"] == [{"_id": 1, "num_users": 1}]
+
+    # moving a document from user a to b patches the top list and the histogram
+    moved = dict(docs[1], created={"user": "b"})
+    old, docs[1] = docs[1], moved
+    assert apply_edit(results, old, moved, user_count) == set()
+    assert results[USER_REPORT] == compute(docs)[USER_REPORT]
+    assert present(results)["top_user"] == [{"_id": "b", "count": 2}]
+
+    try:
+        set_field(new, "cuisine.kind", "x")
+        assert False, "set a field inside a string"
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import xml.etree.cElementTree as ET
+import struct
+import hashlib
+import math
+import json
+import pprint
+from collections import defaultdict
+
+from osminput import open_osm
+"""
+Approximate analytics over very large extracts, in fixed memory.
+
+users.process_map keeps every uid in a set and the top user / one time user
+reports in finalProject need the whole data set loaded into MongoDB. For
+country or planet sized extracts, the parse is streamed through a few sketches
+instead:
+
+- HyperLogLog for the number of distinct users (uid, as in users.py).
+    With 2**p registers the standard error is 1.04 / sqrt(2**p),
+    i.e. about 0.8% for the default p = 14 (16 KB of registers).
+- Count-Min for the frequency of any user, tag key or amenity value.
+    With width w = ceil(e / eps) and depth d = ceil(ln(1 / delta)) an estimate
+    never undercounts and overcounts by more than eps * N with probability
+    1 - delta (N = total count). Defaults: eps = 0.0005, delta = 0.001.
+- SpaceSaving for the top contributors, tag keys and amenity values.
+    With k counters every item with a true count above N / k is kept and
+    each count is overestimated by at most N / k ('error' per item).
+- A hash sample of users for the histogram of contributions per user.
+    Exact counts are kept for the users whose hash falls under a threshold;
+    the threshold halves when more than 'capacity' users are sampled. The
+    histogram is scaled by 1 / rate and the relative error of a bucket is
+    about 1 / sqrt(number of sampled users in that bucket).
+
+All sketches can be merged, so shards of an extract can be processed in
+parallel and combined afterwards (see merge_sketches and merge_files). Shards
+must use the same parameters.
+"""
+
+MAX_HASH = 2 ** 64
+
+
+def hash64(value):
+    """ Stable 64 bit hash of a string, the same in every process """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """ Distinct count estimator """
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> (64 - self.p)
+        rest = (h << self.p) & (MAX_HASH - 1)
+        rank = 1
+        while rank <= 64 - self.p and not rest & (1 << 63):
+            rest <<= 1
+            rank += 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = float(self.m)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(chr(0))
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        assert self.p == other.p
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+
+    def to_dict(self):
+        return {"p": self.p, "registers": str(self.registers).encode('base64')}
+
+    @classmethod
+    def from_dict(cls, d):
+        hll = cls(d["p"])
+        hll.registers = bytearray(d["registers"].decode('base64'))
+        return hll
+
+
+class CountMin(object):
+    """ Frequency estimator, never undercounts """
+
+    def __init__(self, eps=0.0005, delta=0.001):
+        self.eps = eps
+        self.delta = delta
+        self.width = int(math.ceil(math.e / eps))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.table = [[0] * self.width for _ in range(self.depth)]
+        self.total = 0
+
+    def _cells(self, value):
+        h = hash64(value)
+        h1, h2 = h & 0xffffffff, h >> 32
+        return [(row, (h1 + row * h2) % self.width) for row in range(self.depth)]
+
+    def add(self, value, count=1):
+        self.total += count
+        for row, col in self._cells(value):
+            self.table[row][col] += count
+
+    def estimate(self, value):
+        return min(self.table[row][col] for row, col in self._cells(value))
+
+    def merge(self, other):
+        assert (self.width, self.depth) == (other.width, other.depth)
+        self.total += other.total
+        for mine, theirs in zip(self.table, other.table):
+            for i, c in enumerate(theirs):
+                mine[i] += c
+
+    def to_dict(self):
+        return {"eps": self.eps, "delta": self.delta, "total": self.total, "table": self.table}
+
+    @classmethod
+    def from_dict(cls, d):
+        cm = cls(d["eps"], d["delta"])
+        cm.total = d["total"]
+        cm.table = d["table"]
+        return cm
+
+
+class _Bucket(object):
+    """ The items of a SpaceSaving sketch that share one count """
+    __slots__ = ("count", "items", "prev", "next")
+
+    def __init__(self, count):
+        self.count = count
+        self.items = set()
+        self.prev = self.next = None
+
+
+class SpaceSaving(object):
+    """ Top-k heavy hitters with k counters.
+
+    The counters are kept in a stream-summary: a linked list of buckets in
+    increasing count order, so the item to evict is in the first bucket and a
+    +1 increment moves an item to the next bucket, both in O(1).
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.total = 0
+        self._bucket = {}    # item -> bucket
+        self._error = {}     # item -> overestimation
+        self._head = None    # bucket with the smallest count
+
+    def _insert_after(self, bucket, prev):
+        """ Link 'bucket' after 'prev' (at the head when prev is None) """
+        bucket.prev = prev
+        bucket.next = prev.next if prev is not None else self._head
+        if bucket.next is not None:
+            bucket.next.prev = bucket
+        if prev is not None:
+            prev.next = bucket
+        else:
+            self._head = bucket
+
+    def _unlink(self, bucket):
+        if bucket.prev is not None:
+            bucket.prev.next = bucket.next
+        else:
+            self._head = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+
+    def _place(self, item, count, after):
+        """ Put 'item' in the bucket for 'count', searching forward from bucket 'after' """
+        prev = after
+        nxt = after.next if after is not None else self._head
+        while nxt is not None and nxt.count < count:
+            prev, nxt = nxt, nxt.next
+        if nxt is not None and nxt.count == count:
+            bucket = nxt
+        else:
+            bucket = _Bucket(count)
+            self._insert_after(bucket, prev)
+        bucket.items.add(item)
+        self._bucket[item] = bucket
+
+    def _remove(self, item):
+        """ Take 'item' out of its bucket, return the bucket before its position """
+        bucket = self._bucket.pop(item)
+        bucket.items.discard(item)
+        if bucket.items:
+            return bucket
+        self._unlink(bucket)
+        return bucket.prev
+
+    def add(self, item, count=1):
+        self.total += count
+        bucket = self._bucket.get(item)
+        if bucket is not None:
+            new_count = bucket.count + count
+            self._place(item, new_count, self._remove(item))
+        elif len(self._bucket) < self.k:
+            self._error[item] = 0
+            self._place(item, count, None)
+        else:
+            floor = self._head.count
+            victim = next(iter(self._head.items))
+            after = self._remove(victim)
+            del self._error[victim]
+            self._error[item] = floor
+            self._place(item, floor + count, after)
+
+    @property
+    def counters(self):
+        """ item -> [count, error] """
+        return dict((item, [b.count, self._error[item]]) for item, b in self._bucket.items())
+
+    def _load(self, counters):
+        self._bucket, self._error, self._head = {}, {}, None
+        tail = None
+        for item, (count, error) in sorted(counters.items(), key=lambda kv: kv[1][0]):
+            self._error[item] = error
+            self._place(item, count, tail.prev if tail is not None and tail.count == count else tail)
+            tail = self._bucket[item]
+
+    def top(self, n=10):
+        """ List of (item, count, error) with the largest counts first """
+        ranked = sorted(self.counters.items(), key=lambda kv: -kv[1][0])[:n]
+        return [(item, c[0], c[1]) for item, c in ranked]
+
+    def merge(self, other):
+        """ Merge the counters, an item missing from one side gets that side's minimum """
+        def floor(s):
+            return s._head.count if len(s._bucket) >= s.k else 0
+        mine, theirs = floor(self), floor(other)
+        ours, others = self.counters, other.counters
+        merged = {}
+        for item in set(ours) | set(others):
+            a = ours.get(item, [mine, mine])
+            b = others.get(item, [theirs, theirs])
+            merged[item] = [a[0] + b[0], a[1] + b[1]]
+        ranked = sorted(merged.items(), key=lambda kv: -kv[1][0])[:self.k]
+        self._load(dict(ranked))
+        self.total += other.total
+
+    def to_dict(self):
+        return {"k": self.k, "total": self.total, "counters": self.counters}
+
+    @classmethod
+    def from_dict(cls, d):
+        ss = cls(d["k"])
+        ss.total = d["total"]
+        ss._load(d["counters"])
+        return ss
+
+
+class UserSample(object):
+    """ Exact contribution counts for a hash sample of the users """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.threshold = MAX_HASH
+        self.counts = {}
+
+    def add(self, user, count=1):
+        if hash64(user) < self.threshold:
+            self.counts[user] = self.counts.get(user, 0) + count
+            self._shrink()
+
+    def _shrink(self):
+        while len(self.counts) > self.capacity:
+            self.threshold //= 2
+            self.counts = dict((u, c) for u, c in self.counts.items()
+                               if hash64(u) < self.threshold)
+
+    def rate(self):
+        return float(self.threshold) / MAX_HASH
+
+    def histogram(self):
+        """ Estimated number of users per number of contributions """
+        hist = defaultdict(int)
+        for c in self.counts.values():
+            hist[c] += 1
+        scale = 1 / self.rate()
+        return dict((c, int(round(n * scale))) for c, n in hist.items())
+
+    def merge(self, other):
+        self.threshold = min(self.threshold, other.threshold)
+        counts = defaultdict(int)
+        for sample in (self.counts, other.counts):
+            for u, c in sample.items():
+                if hash64(u) < self.threshold:
+                    counts[u] += c
+        self.counts = dict(counts)
+        self._shrink()
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "threshold": self.threshold, "counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, d):
+        sample = cls(d["capacity"])
+        sample.threshold = d["threshold"]
+        sample.counts = d["counts"]
+        return sample
+
+
+SKETCH_TYPES = {"distinct_users": HyperLogLog,
+                "user_counts": CountMin,
+                "top_users": SpaceSaving,
+                "top_tag_keys": SpaceSaving,
+                "top_amenities": SpaceSaving,
+                "user_sample": UserSample}
+
+
+def new_sketches(p=14, eps=0.0005, delta=0.001, k=100, capacity=10000):
+    return {"distinct_users": HyperLogLog(p),
+            "user_counts": CountMin(eps, delta),
+            "top_users": SpaceSaving(k),
+            "top_tag_keys": SpaceSaving(k),
+            "top_amenities": SpaceSaving(k),
+            "user_sample": UserSample(capacity)}
+
+
+def get_elements(filename, tags=('node', 'way', 'relation')):
+    """ Yield the top level elements, clearing the tree as we go """
+    with open_osm(filename) as osm:
+        context = iter(ET.iterparse(osm, events=('start', 'end')))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+
+
+def process_map(filename, sketches=None):
+    """ Stream the map file through the sketches """
+    if sketches is None:
+        sketches = new_sketches()
+    for element in get_elements(filename):
+        if 'uid' in element.attrib:
+            sketches["distinct_users"].add(element.attrib['uid'])
+        user = element.attrib.get('user')
+        if user is not None:
+            sketches["user_counts"].add(user)
+            sketches["top_users"].add(user)
+            sketches["user_sample"].add(user)
+        for tag in element.iter("tag"):
+            sketches["top_tag_keys"].add(tag.attrib['k'])
+            if tag.attrib['k'] == "amenity":
+                sketches["top_amenities"].add(tag.attrib['v'])
+    return sketches
+
+
+def report(sketches, n=10):
+    """ Approximate counterparts of the user reports in finalProject """
+    histogram = sketches["user_sample"].histogram()
+    return {"distinct_users": sketches["distinct_users"].count(),
+            "top_user": sketches["top_users"].top(1),
+            "top_users": sketches["top_users"].top(n),
+            "one_time_users": histogram.get(1, 0),
+            "contributions_histogram": histogram,
+            "top_tag_keys": sketches["top_tag_keys"].top(n),
+            "top_amenities": sketches["top_amenities"].top(n)}
+
+
+def merge_sketches(sketches, other):
+    for name, sketch in sketches.items():
+        sketch.merge(other[name])
+    return sketches
+
+
+def save_sketches(sketches, filename):
+    with open(filename, "w") as fo:
+        json.dump(dict((name, s.to_dict()) for name, s in sketches.items()), fo)
+
+
+def load_sketches(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    return dict((name, SKETCH_TYPES[name].from_dict(d)) for name, d in data.items())
+
+
+def merge_files(filenames):
+    """ Combine the sketches saved from several shards """
+    sketches = load_sketches(filenames[0])
+    for filename in filenames[1:]:
+        merge_sketches(sketches, load_sketches(filename))
+    return sketches
+
+
+def test():
+    import users
+    exact = users.process_map('example.osm')
+    sketches = process_map('example.osm')
+    result = report(sketches)
+    pprint.pprint(result)
+    assert result["distinct_users"] == len(exact)
+
+    # two shards merged give the same answer as one pass
+    shard = process_map('example.osm')
+    save_sketches(shard, 'example.osm.sketch')
+    merged = merge_sketches(process_map('example.osm'), load_sketches('example.osm.sketch'))
+    assert merged["distinct_users"].count() == len(exact)
+    assert merged["top_users"].top(1)[0][1] == 2 * result["top_user"][0][1]
+
+    # the stream-summary keeps the same counts as the plain SpaceSaving algorithm
+    import random
+    rng = random.Random(2013)
+    ss, naive = SpaceSaving(10), {}
+    for _ in range(5000):
+        item = str(int(rng.paretovariate(1.2)))
+        ss.add(item)
+        if item in naive:
+            naive[item][0] += 1
+        elif len(naive) < 10:
+            naive[item] = [1, 0]
+        else:
+            floor = min(c[0] for c in naive.values())
+            victim = [i for i in naive if naive[i][0] == floor][0]
+            del naive[victim]
+            naive[item] = [floor + 1, floor]
+    assert sorted(c for c, _ in ss.counters.values()) == sorted(c for c, _ in naive.values())
+    assert SpaceSaving.from_dict(ss.to_dict()).counters == ss.counters
+
+
+if __name__ == "__main__":
+    test()
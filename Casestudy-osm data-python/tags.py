@@ -3,6 +3,8 @@
 import xml.etree.cElementTree as ET
 import pprint
 import re
+
+from osminput import open_osm
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into your database, you should check the
@@ -47,8 +49,9 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    with open_osm(filename) as osm:
+        for _, element in ET.iterparse(osm):
+            keys = key_type(element, keys)
 
     return keys
 
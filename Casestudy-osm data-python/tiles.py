@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import glob
+import math
+import json
+import time
+import bisect
+import subprocess
+import pprint
+from array import array
+from collections import OrderedDict
+
+from finalProject import shape_element
+from sketches import get_elements
+from osmindex import _int64_array
+from reportcache import MONGO_URI, bump_generation_at
+"""
+Tile partitioned output for the shaped documents.
+
+process_map in finalProject writes one big <file>.osm.json that can only be
+loaded serially. process_map_tiles writes the same documents into one file per
+tile instead, in '<file>.tiles/', keyed by the quadkey (Bing maps tiles) or the
+geohash of 'pos':
+
+- nodes are placed by their own position
+- ways have no position, they are placed by their first node ("first") or by
+  the centroid of their nodes ("centroid")
+- documents that can't be placed (e.g. ways whose nodes are not in the extract)
+  go to the tile "unplaced"
+
+Each tile file holds one json document per line, which is what mongoimport
+expects without --jsonArray. 'manifest.json' lists for every tile its file, the
+number of nodes and ways and the bounding box [min_lat, min_lon, max_lat, max_lon]
+of the positions that went into it. A run starts by removing the tile files of
+the previous run, so the directory always matches its manifest. With the manifest the tiles can be loaded
+in parallel (load_tiles) and regional jobs only need to touch the tiles that
+overlap their area (tiles_in_bbox).
+"""
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_OPEN_FILES = 64
+
+
+def quadkey(lat, lon, level):
+    """ Quadkey of the web mercator tile containing (lat, lon) at zoom 'level' """
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    size = 1 << level
+    tx = min(max(int(x * size), 0), size - 1)
+    ty = min(max(int(y * size), 0), size - 1)
+    digits = []
+    for i in range(level, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if tx & mask else 0) + (2 if ty & mask else 0)))
+    return "".join(digits)
+
+
+def geohash(lat, lon, precision):
+    """ Geohash of (lat, lon) with 'precision' characters """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, bit, even = 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            rng[0] = mid
+        else:
+            bits = bits * 2
+            rng[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits, bit = 0, 0
+    return "".join(chars)
+
+
+TILE_SCHEMES = {"quadkey": quadkey, "geohash": geohash}
+
+
+class NodePositions(object):
+    """ Compact id -> (lat, lon) table: sorted parallel arrays instead of a dict """
+
+    def __init__(self):
+        self.ids = _int64_array()
+        self.lats = array('d')
+        self.lons = array('d')
+        self.ordered = True
+
+    def add(self, ident, pos):
+        ident = int(ident)
+        if self.ids and ident < self.ids[-1]:
+            self.ordered = False
+        self.ids.append(ident)
+        self.lats.append(pos[0])
+        self.lons.append(pos[1])
+
+    def _sort(self):
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        ids = _int64_array()
+        ids.extend(self.ids[i] for i in order)
+        self.ids = ids
+        self.lats = array('d', [self.lats[i] for i in order])
+        self.lons = array('d', [self.lons[i] for i in order])
+        self.ordered = True
+
+    def get(self, ident):
+        if not self.ordered:
+            self._sort()
+        ident = int(ident)
+        i = bisect.bisect_left(self.ids, ident)
+        if i < len(self.ids) and self.ids[i] == ident:
+            return [self.lats[i], self.lons[i]]
+        return None
+
+
+def way_position(way, positions, method="first"):
+    """ Position used to place a way: its first known node, or the centroid of its nodes """
+    points = []
+    for ref in way.get('node_refs', []):
+        pos = positions.get(ref)
+        if pos is not None:
+            if method == "first":
+                return pos
+            points.append(pos)
+    if not points:
+        return None
+    return [sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)]
+
+
+class TileWriter(object):
+    """ Appends documents to per tile files, keeping a bounded number of files open """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = OrderedDict()
+        self.tiles = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            os.remove(path)
+
+    def _file(self, tile):
+        if tile in self.files:
+            fo = self.files.pop(tile)
+        else:
+            if len(self.files) >= MAX_OPEN_FILES:
+                self.files.popitem(last=False)[1].close()
+            mode = "a" if tile in self.tiles else "w"
+            fo = open(os.path.join(self.directory, "{0}.json".format(tile)), mode)
+        self.files[tile] = fo
+        return fo
+
+    def write(self, tile, doc, pos):
+        fo = self._file(tile)
+        info = self.tiles.get(tile)
+        if info is None:
+            info = self.tiles[tile] = {"file": "{0}.json".format(tile), "count": 0,
+                                       "node": 0, "way": 0, "bbox": None}
+        fo.write(json.dumps(doc) + "\n")
+        info["count"] += 1
+        info[doc['type']] += 1
+        if pos is not None:
+            box = info["bbox"]
+            if box is None:
+                info["bbox"] = [pos[0], pos[1], pos[0], pos[1]]
+            else:
+                info["bbox"] = [min(box[0], pos[0]), min(box[1], pos[1]),
+                                max(box[2], pos[0]), max(box[3], pos[1])]
+
+    def close(self):
+        for fo in self.files.values():
+            fo.close()
+        self.files.clear()
+
+
+def process_map_tiles(file_in, scheme="quadkey", level=None, way_method="first"):
+    """ Shape the map file like process_map, writing one file per tile plus a manifest """
+    tile_of = TILE_SCHEMES[scheme]
+    if level is None:
+        level = 12 if scheme == "quadkey" else 5
+    directory = "{0}.tiles".format(file_in)
+    positions = NodePositions()
+    writer = TileWriter(directory)
+    try:
+        for element in get_elements(file_in):
+            el = shape_element(element)
+            if not el:
+                continue
+            if el['type'] == "node":
+                pos = el.get('pos')
+                if pos is not None and 'id' in el:
+                    positions.add(el['id'], pos)
+            else:
+                pos = way_position(el, positions, way_method)
+            tile = tile_of(pos[0], pos[1], level) if pos is not None else "unplaced"
+            writer.write(tile, el, pos)
+    finally:
+        writer.close()
+
+    manifest = {"source": file_in, "scheme": scheme, "level": level,
+                "way_position": way_method, "tiles": writer.tiles}
+    with open(os.path.join(directory, "manifest.json"), "w") as fo:
+        json.dump(manifest, fo, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, "manifest.json")) as f:
+        return json.load(f)
+
+
+def tiles_in_bbox(manifest, bbox):
+    """ Tiles whose bounding box overlaps [min_lat, min_lon, max_lat, max_lon] """
+    found = []
+    for tile, info in manifest["tiles"].items():
+        box = info["bbox"]
+        if box and box[0] <= bbox[2] and box[2] >= bbox[0] and box[1] <= bbox[3] and box[3] >= bbox[1]:
+            found.append(tile)
+    return sorted(found)
+
+
+def load_tiles(directory, db="examples", collection="sanjose", workers=4,
+               mongoimport="/usr/local/bin/mongoimport", tiles=None, mongo_uri=MONGO_URI):
+    """ Load the tiles into MongoDB with up to 'workers' mongoimport processes at once.
+    Returns the tiles that failed; if any tile was imported the cached report is stale """
+    manifest = load_manifest(directory)
+    pending = sorted(tiles if tiles is not None else manifest["tiles"])
+    total = len(pending)
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < workers:
+            tile = pending.pop()
+            path = os.path.join(directory, manifest["tiles"][tile]["file"])
+            running.append((tile, subprocess.Popen([mongoimport, "--db", db, "--collection",
+                                                     collection, "--file", path])))
+        for tile, proc in running[:]:
+            if proc.poll() is not None:
+                running.remove((tile, proc))
+                if proc.returncode != 0:
+                    failed.append(tile)
+        time.sleep(0.05)
+    if len(failed) < total:
+        bump_generation_at(db, collection, mongo_uri)
+    return failed
+
+
+def test():
+    import finalProject
+    data = finalProject.process_map('example.osm')
+    with open(os.path.join(TileWriter('example.osm.tiles').directory, "stale.json"), "w") as fo:
+        fo.write("{}\n")
+    manifest = process_map_tiles('example.osm', "quadkey", 14)
+    pprint.pprint(dict((t, i["count"]) for t, i in manifest["tiles"].items()))
+    assert sum(info["count"] for info in manifest["tiles"].values()) == len(data)
+
+    docs = []
+    for info in manifest["tiles"].values():
+        with open(os.path.join('example.osm.tiles', info["file"])) as f:
+            docs.extend(json.loads(line) for line in f)
+    assert sorted(d['id'] for d in docs) == sorted(d['id'] for d in data)
+    assert sorted(glob.glob(os.path.join('example.osm.tiles', "*.json"))) == sorted(
+        os.path.join('example.osm.tiles', name)
+        for name in [info["file"] for info in manifest["tiles"].values()] + ["manifest.json"])
+
+    node = [d for d in data if d['type'] == "node"][0]
+    lat, lon = node['pos']
+    found = tiles_in_bbox(manifest, [lat, lon, lat, lon])
+    assert quadkey(lat, lon, 14) in found
+
+    positions = NodePositions()
+    for ident in (2 ** 33 + 5, 7, 2 ** 32 + 1):
+        positions.add(ident, (1.0, float(ident % 10)))
+    assert positions.ids.itemsize == 8
+    assert positions.get(2 ** 33 + 5) == [1.0, 7.0] and positions.get(2 ** 32 + 1) == [1.0, 7.0]
+    assert positions.get(2 ** 32 + 7) is None
+
+    assert geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert quadkey(47.6062, -122.3321, 3) == "021"
+
+
+if __name__ == "__main__":
+    test()
@@ -3,6 +3,8 @@
 import xml.etree.cElementTree as ET
 import pprint
 import re
+
+from osminput import open_osm
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -17,10 +19,11 @@ def get_user(element):
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
-        uid = get_user(element)
-        if uid != None:
-            users.add(uid)
+    with open_osm(filename) as osm:
+        for _, element in ET.iterparse(osm):
+            uid = get_user(element)
+            if uid != None:
+                users.add(uid)
 
     return users
 